@@ -63,7 +63,7 @@ def main(deploy_data: dict, train_data: dict, capture_prefix: str):
 
     # read test data
     test_data = load_dataset(
-        train_data['train']['test'], 'test.csv', sagemaker_session=sm_session)
+        train_data['train']['test'], 'test', sagemaker_session=sm_session)
     print(f"Loadding {train_data['train']['test']}.")
     Y_val = test_data.iloc[:, 0].to_numpy()
     print(f"Test dataset shape: {Y_val.shape}")
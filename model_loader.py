@@ -1,15 +1,42 @@
 """This will be used as an entry point when serving the model"""
 from sagemaker_containers.beta.framework import content_types, encoders
 import numpy as np
-import joblib
+import functools
 import os
+import sys
+from io import StringIO
+
+def load_classifier(model_dir):
+    """Loads the classifier of the model artifact.
+
+    The compact model.npz, with compact_model.py, is preferred: it is
+    predicted with NumPy only, without importing sklearn. The artifacts of
+    the models that are not linear have only the joblib model.
+    """
+    if os.path.exists(os.path.join(model_dir, "model.npz")) and \
+            os.path.exists(os.path.join(model_dir, "compact_model.py")):
+        # compact_model.py is saved with the model by training.py
+        sys.path.insert(0, model_dir)
+        from compact_model import load_model
+        return load_model(os.path.join(model_dir, "model.npz"))
+    import joblib
+    return joblib.load(os.path.join(model_dir, "model.joblib"))
+
 
 def model_fn(model_dir):
     """Deserialized and return fitted model
     Note that this should have the same name as the serialized model in the main method
     """
-    clf = joblib.load(os.path.join(model_dir, "model.joblib"))
-    return clf
+    clf = load_classifier(model_dir)
+    statistics_path = os.path.join(model_dir, "transform.json")
+    if not os.path.exists(statistics_path):
+        # model trained without the imputation statistics
+        return clf, None
+    # transform.py is saved with the model by training.py
+    sys.path.insert(0, model_dir)
+    from transform import load_statistics, transform
+    return clf, functools.partial(
+        transform, statistics=load_statistics(statistics_path))
 
 
 def input_fn(input_data, content_type):
@@ -25,8 +52,15 @@ def input_fn(input_data, content_type):
     Returns:
         (obj): data ready for prediction.
     """
-    np_array = encoders.decode(input_data, content_type)
-    ret = np_array.astype(np.float32) if content_type in content_types.UTF8_TYPES else np_array
+    if content_type == content_types.CSV:
+        # parsed directly as float32, the dtype of the training features
+        if isinstance(input_data, bytes):
+            input_data = input_data.decode("utf-8")
+        ret = np.loadtxt(
+            StringIO(input_data), delimiter=",", dtype=np.float32, ndmin=1)
+    else:
+        np_array = encoders.decode(input_data, content_type)
+        ret = np_array.astype(np.float32, copy=False)
     # reshaping if contains a single sample, necesary if when using CSV as
     # content_type
     if len(ret.shape) == 1:
@@ -34,3 +68,15 @@ def input_fn(input_data, content_type):
         ret = ret.reshape(1,-1)
 
     return ret
+
+
+def predict_fn(input_data, model):
+    """Scales and imputes the features as preprocess does, then predicts.
+
+    The rows of the splits are left unchanged by the transform, rows with
+    missing values are imputed with the statistics of the train split.
+    """
+    clf, features_transform = model
+    if features_transform is not None:
+        input_data = features_transform(input_data)
+    return clf.predict(input_data)
@@ -90,7 +90,7 @@ def main(resources, train_data):
     # but is necessary to drop the label column (Y_train)
     _l.info(f"Loadding {train_data['train']['train']}")
     train_set = load_dataset(
-        train_data['train']['train'], 'train.csv', 
+        train_data['train']['train'], 'train',
         sagemaker_session=sm_session)
     # drop Y_train
     train_set.drop(train_set.columns[0], axis=1, inplace=True)
@@ -0,0 +1,110 @@
+"""Compact artifact of the linear models, predicted with NumPy only.
+
+A fitted linear classifier, e.g. the LogisticRegression or the
+SGDClassifier of training.py, is exported to model.npz with its
+coefficients, intercept, class labels and feature names. This module is
+copied with it in the model artifact by training.py and model_loader.py
+serves the model.npz when there is one: no sklearn import on the endpoint cold
+start and no input validation of sklearn on each request.
+
+The predictions are the ones of sklearn: the decision function is computed
+with the same dtypes and the same operations as
+sklearn.linear_model.LinearClassifierMixin.
+"""
+import numpy as np
+
+FILENAME = "model.npz"
+# version of the model.npz content
+FORMAT_VERSION = 1
+
+
+class CompactLinearModel:
+    """A linear classifier with the predict of sklearn, in NumPy only."""
+
+    def __init__(self, coef, intercept, classes, feature_names=None):
+        self.coef_ = np.asarray(coef)
+        self.intercept_ = np.asarray(intercept)
+        self.classes_ = np.asarray(classes)
+        self.feature_names = (
+            None if feature_names is None else list(feature_names))
+
+    @property
+    def n_features_in_(self):
+        return self.coef_.shape[1]
+
+    def decision_function(self, X):
+        """Returns the confidence scores of the rows of X.
+
+        Raises:
+            ValueError: if X has no rows or not the features of the model
+        """
+        X = np.asarray(X)
+        if X.ndim == 1:
+            X = X.reshape(1, -1)
+        if not np.issubdtype(X.dtype, np.floating):
+            X = X.astype(np.float64)
+        if X.shape[0] == 0:
+            raise ValueError("X has no rows to predict")
+        if X.shape[1] != self.n_features_in_:
+            raise ValueError(
+                f"X has {X.shape[1]} features per sample; expecting "
+                f"{self.n_features_in_}")
+        scores = X @ self.coef_.T + self.intercept_
+        return scores.ravel() if scores.shape[1] == 1 else scores
+
+    def predict(self, X):
+        """Returns the class labels of the rows of X."""
+        scores = self.decision_function(X)
+        if scores.ndim == 1:
+            indices = (scores > 0).astype(np.int64)
+        else:
+            indices = scores.argmax(axis=1)
+        return self.classes_[indices]
+
+
+def export_model(model, path, feature_names=None):
+    """Writes the compact artifact of a fitted linear classifier.
+
+    The coefficients keep the dtype of the model, float64 for the solvers of
+    training.py: rounded to float32 they would change the predictions of the
+    rows close to the decision boundary.
+
+    Args:
+        model: the fitted estimator
+        path: the .npz file
+        feature_names: the names of the features, in the columns order
+
+    Returns:
+        True if the artifact was written, False if the model is not linear,
+        e.g. a tournament random forest
+    """
+    if not all(
+            hasattr(model, name)
+            for name in ("coef_", "intercept_", "classes_")):
+        return False
+    np.savez(
+        path,
+        format_version=np.array(FORMAT_VERSION),
+        coef=np.asarray(model.coef_),
+        intercept=np.asarray(model.intercept_),
+        classes=np.asarray(model.classes_),
+        feature_names=np.array(
+            [] if feature_names is None else list(feature_names), dtype=str),
+    )
+    return True
+
+
+def load_model(path):
+    """Loads the compact artifact written by `export_model`.
+
+    Raises:
+        ValueError: if the artifact is of an unknown format version
+    """
+    with np.load(path, allow_pickle=False) as artifact:
+        version = int(artifact["format_version"])
+        if version != FORMAT_VERSION:
+            raise ValueError(f"Unknown {FILENAME} format version {version}")
+        feature_names = artifact["feature_names"].tolist()
+        return CompactLinearModel(
+            artifact["coef"], artifact["intercept"], artifact["classes"],
+            feature_names or None)
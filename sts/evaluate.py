@@ -1,63 +1,179 @@
-"""Evaluation script for measuring mean squared error."""
+"""Evaluation script for measuring mean squared error.
+
+The model is loaded once and scores every split given to the job, chunk by
+chunk, in a single pass that writes both the evaluation report used for the
+model registration and the baseline dataset of the model quality monitor.
+
+The report also has the inference latency of the model: its load time, the
+percentiles of the predict latency of single rows, as the endpoint gets them,
+and the throughput of the chunked predictions.
+"""
+import os
 import json
 import logging
 import pathlib
-import pickle
-import tarfile
-from subprocess import run
+import argparse
+import sys
+import time
 
 import numpy as np
-import pandas as pd
 
-from sklearn.metrics import mean_squared_error
-import joblib
+# splits.py and inference.py are given to the processing job as inputs, see
+# pipeline.py
+sys.path.insert(0, "/opt/ml/processing/input/splits")
+sys.path.insert(0, "/opt/ml/processing/input/inference")
+from inference import load_model, single_row_latencies
+from splits import read_split
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 logger.addHandler(logging.StreamHandler())
 
+base_dir = "/opt/ml/processing"
+
+
+def score_split(model, X, y, chunk_size=65536):
+    """Yields the predictions of a split, chunk by chunk of rows.
+
+    Args:
+        model: the fitted estimator
+        X: the split features, e.g. memory mapped, only a chunk at a time is
+            read
+        y: the split labels
+        chunk_size: the rows predicted at once
+
+    Yields:
+        tuples (predictions, labels, seconds) of each chunk, with the time
+        taken to read and predict the chunk
+    """
+    for start in range(0, len(X), chunk_size):
+        begin = time.perf_counter()
+        predictions = model.predict(X[start:start + chunk_size])
+        yield (
+            predictions, y[start:start + chunk_size],
+            time.perf_counter() - begin)
+
+
+class RegressionMetrics:
+    """Mean squared error and standard deviation of the errors, computed
+    chunk by chunk."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.squares = 0.0
+
+    def update(self, predictions, labels):
+        errors = np.asarray(labels, dtype=np.float64) - predictions
+        self.count += len(errors)
+        self.total += errors.sum()
+        self.squares += np.square(errors).sum()
+
+    def report(self):
+        mse = self.squares / self.count
+        std = np.sqrt(max(mse - (self.total / self.count) ** 2, 0.0))
+        return {
+            "regression_metrics": {
+                "mse": {
+                    "value": float(mse),
+                    "standard_deviation": float(std)
+                },
+            },
+        }
+
+
+def latency_report(load_time, latencies, rows, predict_time):
+    """Returns the latency metrics of the evaluation report.
+
+    Args:
+        load_time: the model load time, in seconds
+        latencies: the single row latencies, see `single_row_latencies`
+        rows: the number of rows of the chunked predictions
+        predict_time: the time of the chunked predictions, in seconds
+    """
+    report = {"load_time_ms": {"value": load_time * 1000}}
+    if len(latencies):
+        for percentile in (50, 90, 99):
+            report[f"predict_p{percentile}_ms"] = {
+                "value": float(np.percentile(latencies, percentile))}
+    if predict_time > 0:
+        report["throughput_rows_per_s"] = {"value": rows / predict_time}
+    return report
 
 
 if __name__ == "__main__":
     logger.debug("Starting evaluation.")
-    logger.info(run("ls /opt/ml/processing/model/", shell=True))
 
-    model_path = "/opt/ml/processing/model/model.tar.gz"
-    with tarfile.open(model_path) as tar:
-        tar.extractall(path=".")
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--evaluation-split", type=str, default="test",
+        help="the split of the evaluation report, empty for no report")
+    parser.add_argument(
+        "--baseline-split", type=str, default="validation",
+        help="the split of the model quality baseline, empty for no "
+             "baseline")
+    parser.add_argument(
+        "--chunk-size", type=int, default=65536,
+        help="rows predicted at once")
+    parser.add_argument(
+        "--latency-samples", type=int, default=200,
+        help="rows of the evaluation split predicted one at a time to "
+             "measure the single row latency")
+    args, _ = parser.parse_known_args()
 
     logger.debug("Loading sklearn model.")
-    # model = pickle.load(open("model.pkl", "rb"))
-    model = joblib.load("model.joblib")
-
-    logger.debug("Reading test data.")
-    test_path = "/opt/ml/processing/test/test.csv"
-    df = pd.read_csv(test_path, header=None)
-
-    logger.debug("Reading test data.")
-    y_test = df.iloc[:, 0].to_numpy()
-    df.drop(df.columns[0], axis=1, inplace=True)
-    X_test = df.values
-
-    logger.info("Performing predictions against test data.")
-    predictions = model.predict(X_test)
-
-    logger.debug("Calculating mean squared error.")
-    mse = mean_squared_error(y_test, predictions)
-    std = np.std(y_test - predictions)
-    report_dict = {
-        "regression_metrics": {
-            "mse": {
-                "value": mse,
-                "standard_deviation": std
-            },
-        },
-    }
+    start = time.perf_counter()
+    model = load_model(f"{base_dir}/model/model.tar.gz")
+    load_time = time.perf_counter() - start
+
+    evaluation_dir = f"{base_dir}/evaluation"
+    baseline_dir = f"{base_dir}/validate"
+    metrics = RegressionMetrics()
+    baseline = None
+    latencies = np.array([])
+    scored_rows, predict_time = 0, 0.0
+    if args.baseline_split:
+        pathlib.Path(baseline_dir).mkdir(parents=True, exist_ok=True)
+        baseline = open(f"{baseline_dir}/baseline.csv", "w")
+        baseline.write("prediction,label\n")
+
+    # each split is read and predicted once, even when it is used for both
+    # outputs
+    names = [
+        name for name in dict.fromkeys(
+            [args.evaluation_split, args.baseline_split]) if name]
+    for name in names:
+        logger.info("Performing predictions against %s data.", name)
+        X, y, _ = read_split(f"{base_dir}/{name}", name, mmap_mode="r")
+        if name == args.evaluation_split:
+            latencies = single_row_latencies(model, X, args.latency_samples)
+        for predictions, labels, seconds in score_split(
+                model, X, y, args.chunk_size):
+            predict_time += seconds
+            scored_rows += len(predictions)
+            if name == args.evaluation_split:
+                metrics.update(predictions, labels)
+            if name == args.baseline_split:
+                # labels as integers like the model predictions
+                np.savetxt(
+                    baseline, np.column_stack([
+                        predictions.astype(np.int64),
+                        labels.astype(np.int64)]),
+                    fmt="%d", delimiter=",")
+
+    if baseline is not None:
+        baseline.close()
+        logger.info(
+            f"Model quality baseline dataset in {baseline_dir}/baseline.csv")
 
-    output_dir = "/opt/ml/processing/evaluation"
-    pathlib.Path(output_dir).mkdir(parents=True, exist_ok=True)
+    if args.evaluation_split:
+        report_dict = metrics.report()
+        report_dict["latency_metrics"] = latency_report(
+            load_time, latencies, scored_rows, predict_time)
+        mse = report_dict["regression_metrics"]["mse"]["value"]
+        pathlib.Path(evaluation_dir).mkdir(parents=True, exist_ok=True)
 
-    logger.info("Writing out evaluation report with mse: %f", mse)
-    evaluation_path = f"{output_dir}/evaluation.json"
-    with open(evaluation_path, "w") as f:
-        f.write(json.dumps(report_dict))
+        logger.info("Writing out evaluation report with mse: %f", mse)
+        evaluation_path = f"{evaluation_dir}/evaluation.json"
+        with open(evaluation_path, "w") as f:
+            f.write(json.dumps(report_dict))
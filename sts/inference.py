@@ -0,0 +1,59 @@
+"""Load the model artifacts written by the training job and measure their
+single row predict latency.
+
+This module is used by the training script, for the model it starts from
+and the latency of the tournament candidates, and by the evaluation script,
+the evaluation step receives it as an input, see pipeline.py.
+"""
+import os
+import time
+import tarfile
+
+import joblib
+import numpy as np
+
+
+def load_model(model_path, name="model.joblib"):
+    """Loads the model of a model.tar.gz without extracting it to disk.
+
+    Args:
+        model_path: the model.tar.gz written by the training job, or a folder
+            holding one, e.g. a training channel
+        name: the file name of the joblib model in the archive
+
+    Returns:
+        the model
+
+    Raises:
+        FileNotFoundError: if there is no model.tar.gz or no model in it
+    """
+    if os.path.isdir(model_path):
+        model_path = os.path.join(model_path, "model.tar.gz")
+    with tarfile.open(model_path) as tar:
+        for member in tar.getmembers():
+            if member.isfile() and os.path.basename(member.name) == name:
+                # the member is read from the archive stream as it is loaded
+                return joblib.load(tar.extractfile(member))
+    raise FileNotFoundError(f"No {name} in {model_path}")
+
+
+def single_row_latencies(model, X, samples=200):
+    """Measures the predict latency of single rows.
+
+    Args:
+        model: the fitted estimator
+        X: the features of the rows to predict, the first ones are used
+        samples: the number of rows predicted one at a time, after a first
+            warm up prediction
+
+    Returns:
+        the latencies in milliseconds
+    """
+    rows = np.asarray(X[:samples + 1])
+    model.predict(rows[:1])
+    latencies = []
+    for i in range(1, len(rows)):
+        start = time.perf_counter()
+        model.predict(rows[i:i + 1])
+        latencies.append((time.perf_counter() - start) * 1000)
+    return np.array(latencies)
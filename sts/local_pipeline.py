@@ -0,0 +1,291 @@
+"""Run the sts pipeline steps locally, without SageMaker.
+
+The steps of pipeline.py run as subprocesses of this python, with the same
+scripts, arguments and container paths: the inputs of a processing step are
+copied to /opt/ml/processing before it runs and its outputs copied from there
+to a local folder afterwards, as SageMaker does with S3. The training step
+gets its channels and model folder from the same environment variables as in
+the SageMaker container.
+
+The processing steps need /opt/ml/processing to be writable, it is emptied
+before each one of them. The input can be a local file or a S3 uri, the
+outputs of the steps are written under the work folder:
+
+    work_dir/
+        preprocess/shards, preprocess/report
+        merge/train, merge/validation, merge/test
+        feature-store/
+        train/model.tar.gz, train/output
+        checkpoints/
+        evaluation/evaluation.json
+        validate/baseline.csv
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import tarfile
+import logging
+import pathlib
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+BASE_DIR = os.path.dirname(os.path.realpath(__file__))
+PROCESSING_DIR = "/opt/ml/processing"
+
+logger = logging.getLogger(__name__)
+
+
+def _copy(source, destination):
+    """Copies a file or a folder content to a folder, like a S3 transfer."""
+    pathlib.Path(destination).mkdir(parents=True, exist_ok=True)
+    if os.path.isdir(source):
+        shutil.copytree(source, destination, dirs_exist_ok=True)
+    elif os.path.exists(source):
+        shutil.copy(source, destination)
+
+
+def _run(command, env=None, cwd=None):
+    """Runs a step script, raises `subprocess.CalledProcessError` if it fails."""
+    logger.debug("Running %s", " ".join(command))
+    subprocess.run(
+        command, check=True, cwd=cwd, env=dict(os.environ, **(env or {})))
+
+
+def run_processing(script, arguments=(), inputs=None, outputs=None,
+                   instance_count=1):
+    """Runs a processing step like a SageMaker processing job.
+
+    Args:
+        script: path of the processing script
+        arguments: the job arguments
+        inputs: dict of local source (file or folder) -> container
+            destination folder
+        outputs: dict of container source folder -> local destination
+            folder, the previous content of the destination is removed, as
+            the outputs of a new job go to a new S3 prefix
+        instance_count: the number of hosts, each one runs the script in its
+            own process with --host-rank and --host-count arguments, see
+            preprocess.py
+    """
+    shutil.rmtree(PROCESSING_DIR, ignore_errors=True)
+    for source, destination in (inputs or {}).items():
+        _copy(source, destination)
+    for source in (outputs or {}):
+        pathlib.Path(source).mkdir(parents=True, exist_ok=True)
+
+    command = [sys.executable, script] + [str(a) for a in arguments]
+    # each host runs in its own working folder, as on its own instance, but
+    # they share /opt/ml/processing: the scripts only write their own files
+    # there, e.g. shards/part-<rank>
+    with tempfile.TemporaryDirectory() as work_dir:
+        if instance_count == 1:
+            _run(command, cwd=work_dir)
+        else:
+            host_dirs = [
+                os.path.join(work_dir, f"host-{rank}")
+                for rank in range(instance_count)]
+            for host_dir in host_dirs:
+                os.mkdir(host_dir)
+            with ThreadPoolExecutor(max_workers=instance_count) as executor:
+                runs = [
+                    executor.submit(
+                        _run, command + [
+                            "--host-rank", str(rank),
+                            "--host-count", str(instance_count)],
+                        cwd=host_dirs[rank])
+                    for rank in range(instance_count)]
+                for run in runs:
+                    run.result()
+
+    for source, destination in (outputs or {}).items():
+        shutil.rmtree(destination, ignore_errors=True)
+        _copy(source, destination)
+
+
+def run_training(script, channels, output_path, hyperparameters=None,
+                 environment=None):
+    """Runs a training step like a SageMaker training job.
+
+    Args:
+        script: path of the training script, run from its folder, the
+            source_dir of the estimator
+        channels: dict of channel name -> local folder
+        output_path: local folder of the model.tar.gz and of the output data
+        hyperparameters: dict of the hyperparameters, given as arguments
+        environment: dict of the environment variables of the estimator
+
+    Returns:
+        the path of the model.tar.gz
+    """
+    pathlib.Path(output_path).mkdir(parents=True, exist_ok=True)
+    env = dict(environment or {})
+    env.update({
+        f"SM_CHANNEL_{name.upper()}": path
+        for name, path in channels.items()})
+    arguments = []
+    for name, value in (hyperparameters or {}).items():
+        arguments += [f"--{name}", str(value)]
+    with tempfile.TemporaryDirectory() as model_dir:
+        env["SM_MODEL_DIR"] = model_dir
+        env["SM_OUTPUT_DATA_DIR"] = os.path.join(output_path, "output")
+        _run(
+            [sys.executable, script] + arguments, env=env,
+            cwd=os.path.dirname(script))
+        model_path = os.path.join(output_path, "model.tar.gz")
+        with tarfile.open(model_path, "w:gz") as tar:
+            for name in sorted(os.listdir(model_dir)):
+                tar.add(os.path.join(model_dir, name), arcname=name)
+    return model_path
+
+
+def run_local_pipeline(
+        input_data, work_dir, processing_instance_count=1,
+        processing_workers=0, feature_metrics="all", split_format="npy",
+        mse_threshold=6.0, latency_budget=100.0, training_mode="batch",
+        previous_model=None):
+    """Runs the steps of the sts pipeline locally.
+
+    The arguments are the parameters of the pipeline, see
+    pipeline.get_pipeline. The feature store is work_dir/feature-store, kept
+    between runs. The model is not registered.
+
+    Args:
+        input_data: the dataset, a local file or a S3 uri
+        work_dir: the local folder of the steps outputs
+        processing_instance_count: the number of simulated processing hosts
+        processing_workers: processes computing the features on each host
+        feature_metrics: comma separated distance metrics, or all
+        split_format: format of the splits, npy or csv
+        mse_threshold: the maximum mse of the model to be registered
+        latency_budget: the maximum 99th percentile of the single row
+            predict latency of the model to be registered, in milliseconds
+        training_mode: the training mode, see training.py --mode
+        previous_model: a model.tar.gz, or the folder of one, the
+            incremental training starts from, as the last registered model
+            in the pipeline
+
+    Returns:
+        dict of the steps outputs and of their duration in seconds
+    """
+    work_dir = os.path.abspath(work_dir)
+    store_dir = os.path.join(work_dir, "feature-store")
+    preprocess = os.path.join(BASE_DIR, "preprocess.py")
+    outputs = {"timings": {}}
+
+    def step(name, function, *args, **kwargs):
+        logger.info("Running step %s.", name)
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        outputs["timings"][name] = time.perf_counter() - start
+        logger.info(
+            "Step %s done in %.2f s.", name, outputs["timings"][name])
+        return result
+
+    # processing step for feature engineering
+    step(
+        "PreprocessSTSData", run_processing, preprocess,
+        arguments=[
+            "--input-data", input_data,
+            "--stage", "features",
+            "--workers", processing_workers,
+            "--feature-store", store_dir,
+            "--metrics", feature_metrics,
+        ],
+        inputs={
+            os.path.join(BASE_DIR, "transform.py"):
+                f"{PROCESSING_DIR}/input/transform",
+        },
+        outputs={
+            f"{PROCESSING_DIR}/shards": f"{work_dir}/preprocess/shards",
+            f"{PROCESSING_DIR}/report": f"{work_dir}/preprocess/report",
+        },
+        instance_count=processing_instance_count)
+
+    # merge of the shards in the train, validation and test splits
+    step(
+        "MergeSTSData", run_processing, preprocess,
+        arguments=[
+            "--stage", "merge",
+            "--feature-store", store_dir,
+            "--split-format", split_format,
+        ],
+        inputs={
+            f"{work_dir}/preprocess/shards": f"{PROCESSING_DIR}/shards",
+            os.path.join(BASE_DIR, "transform.py"):
+                f"{PROCESSING_DIR}/input/transform",
+        },
+        outputs={
+            f"{PROCESSING_DIR}/train": f"{work_dir}/merge/train",
+            f"{PROCESSING_DIR}/validation": f"{work_dir}/merge/validation",
+            f"{PROCESSING_DIR}/test": f"{work_dir}/merge/test",
+            f"{PROCESSING_DIR}/feature-store": store_dir,
+        })
+    for name in ("train", "validation", "test"):
+        outputs[name] = f"{work_dir}/merge/{name}"
+
+    # training step for generating model artifacts
+    channels = {
+        "train": outputs["train"],
+        "validation": outputs["validation"],
+    }
+    checkpoint_dir = f"{work_dir}/checkpoints"
+    pathlib.Path(checkpoint_dir).mkdir(parents=True, exist_ok=True)
+    with tempfile.TemporaryDirectory() as previous_dir:
+        if previous_model is not None:
+            # copied, the training output may be the previous model itself
+            _copy(previous_model, previous_dir)
+            channels["model"] = previous_dir
+        outputs["model"] = step(
+            "TrainSTSModel", run_training,
+            os.path.join(BASE_DIR, "training.py"),
+            channels=channels,
+            output_path=f"{work_dir}/train",
+            # an interrupted incremental training resumes when run again,
+            # as on spot instances
+            hyperparameters={"checkpoint-dir": checkpoint_dir},
+            environment={
+                "STS_TRAINING_MODE": training_mode,
+                "STS_LATENCY_BUDGET_MS": str(latency_budget),
+            })
+
+    # processing step for evaluation and for the model quality monitoring
+    # baseline data
+    step(
+        "EvaluateSTSModel", run_processing,
+        os.path.join(BASE_DIR, "evaluate.py"),
+        arguments=[
+            "--evaluation-split", "test",
+            "--baseline-split", "validation",
+        ],
+        inputs={
+            outputs["model"]: f"{PROCESSING_DIR}/model",
+            outputs["test"]: f"{PROCESSING_DIR}/test",
+            outputs["validation"]: f"{PROCESSING_DIR}/validation",
+            os.path.join(BASE_DIR, "splits.py"):
+                f"{PROCESSING_DIR}/input/splits",
+            os.path.join(BASE_DIR, "inference.py"):
+                f"{PROCESSING_DIR}/input/inference",
+        },
+        outputs={
+            f"{PROCESSING_DIR}/evaluation": f"{work_dir}/evaluation",
+            f"{PROCESSING_DIR}/validate": f"{work_dir}/validate",
+        })
+    with open(f"{work_dir}/evaluation/evaluation.json") as f:
+        outputs["evaluation"] = json.load(f)
+    outputs["baseline"] = f"{work_dir}/validate/baseline.csv"
+
+    # condition step for evaluating model quality, it only gates the
+    # registration
+    mse = outputs["evaluation"]["regression_metrics"]["mse"]["value"]
+    latency = outputs["evaluation"]["latency_metrics"]["predict_p99_ms"][
+        "value"]
+    outputs["condition"] = mse <= mse_threshold and latency <= latency_budget
+    logger.info(
+        "Model mse %f, threshold %f, p99 latency %f ms, budget %f ms, "
+        "condition %s.", mse, mse_threshold, latency, latency_budget,
+        outputs["condition"])
+
+    return outputs
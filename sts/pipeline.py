@@ -1,19 +1,32 @@
 """Example workflow pipeline script for sts pipeline.
 
-                                               . -RegisterModel
-                                              .
-    Process-> Train -> Evaluate -> Condition .
-                                              .
-                                               . -(stop)
+                                                          . -RegisterModel
+                                                         .
+    Process-> Train -> Evaluate (and Baseline) -> Condition .
+                                                         .
+                                                          . -(stop)
 
 Implements a get_pipeline(**kwargs) method.
+
+The preprocess, merge, train and evaluate steps are cached: a step
+whose code, parameters and inputs are the same as in a previous successful
+execution reuses its outputs instead of running again. The code of the steps
+is uploaded to S3 under the hash of its content, so that an unchanged script
+keeps the same S3 uri. The input data is known by its uri and by the
+InputDataVersion parameter, the ETag or VersionId of the object set by
+trainmodel.py, so that a dataset changed under the same uri runs the steps
+again. To force a refresh, start the pipeline with a new CacheRefreshToken
+value.
 """
 import os
+import hashlib
+import logging
 
 import boto3
 import sagemaker
 import sagemaker.session
 
+from botocore.exceptions import ClientError
 from sagemaker.estimator import Estimator
 from sagemaker.inputs import TrainingInput
 from sagemaker.model_metrics import (
@@ -26,18 +39,22 @@ from sagemaker.processing import (
     ScriptProcessor,
 )
 from sagemaker.sklearn.processing import SKLearnProcessor
+from sagemaker.s3 import S3Uploader
 from sagemaker.workflow.conditions import ConditionLessThanOrEqualTo
 from sagemaker.workflow.condition_step import (
     ConditionStep,
     JsonGet,
 )
+from sagemaker.workflow.functions import Join
 from sagemaker.workflow.parameters import (
+    ParameterFloat,
     ParameterInteger,
     ParameterString,
 )
 from sagemaker.workflow.pipeline import Pipeline
 from sagemaker.workflow.properties import PropertyFile
 from sagemaker.workflow.steps import (
+    CacheConfig,
     ProcessingStep,
     TrainingStep,
 )
@@ -46,6 +63,112 @@ from sagemaker.sklearn import SKLearn
 
 BASE_DIR = os.path.dirname(os.path.realpath(__file__))
 
+logger = logging.getLogger(__name__)
+
+# how long the outputs of a step can be reused, an ISO 8601 duration
+CACHE_EXPIRE_AFTER = "P30D"
+
+
+def content_digest(path):
+    """Returns the sha256 hex digest of a file, or of the files of a folder.
+
+    The python caches of a folder are ignored.
+
+    Args:
+        path: a file or a folder
+
+    Returns:
+        the hex digest, the same as long as the content does not change
+    """
+    digest = hashlib.sha256()
+    if os.path.isdir(path):
+        filenames = []
+        for root, dirs, files in os.walk(path):
+            dirs[:] = sorted(d for d in dirs if d != "__pycache__")
+            filenames += [
+                os.path.join(root, name) for name in files
+                if not name.endswith(".pyc")]
+    else:
+        filenames = [path]
+    for filename in sorted(filenames):
+        digest.update(os.path.relpath(filename, path).encode())
+        with open(filename, "rb") as f:
+            digest.update(hashlib.sha256(f.read()).digest())
+    return digest.hexdigest()
+
+
+def upload_code(path, sagemaker_session, base_job_prefix):
+    """Uploads a script to a S3 uri keyed by the hash of its content.
+
+    The processors upload a local code or input file under the name of the
+    job, which has a timestamp, so the step arguments would change on every
+    pipeline definition and the step would never be found in the cache.
+
+    Args:
+        path: the local file
+        sagemaker_session: the session of the default bucket
+        base_job_prefix: the S3 key prefix
+
+    Returns:
+        the S3 uri of the uploaded file
+    """
+    return S3Uploader.upload(
+        local_path=path,
+        desired_s3_uri=(
+            f"s3://{sagemaker_session.default_bucket()}/{base_job_prefix}/"
+            f"code/{content_digest(path)[:16]}"),
+        sagemaker_session=sagemaker_session,
+    )
+
+
+class CachedSKLearn(SKLearn):
+    """SKLearn estimator whose job name is keyed by its source_dir content.
+
+    The job name is not used by the pipeline, which names the training jobs
+    itself, but it is in the sagemaker_job_name hyperparameter and in the S3
+    uri of the uploaded code, both part of the step cache key.
+    """
+
+    def _prepare_for_training(self, job_name=None):
+        if job_name is None:
+            job_name = (
+                f"{self.base_job_name}-{content_digest(self.source_dir)[:16]}")
+        super()._prepare_for_training(job_name=job_name)
+
+
+def get_latest_model_data(sagemaker_session, model_package_group_name):
+    """Gets the model artifact of the latest approved model package.
+
+    Args:
+        sagemaker_session: the session of the sagemaker client
+        model_package_group_name: the model package group name
+
+    Returns:
+        the S3 uri of the model.tar.gz, None if the group has no approved
+        model yet
+    """
+    sm_client = sagemaker_session.sagemaker_client
+    try:
+        response = sm_client.list_model_packages(
+            ModelPackageGroupName=model_package_group_name,
+            ModelApprovalStatus="Approved",
+            SortBy="CreationTime",
+            SortOrder="Descending",
+            MaxResults=1,
+        )
+        packages = response["ModelPackageSummaryList"]
+        if not packages:
+            return None
+        package = sm_client.describe_model_package(
+            ModelPackageName=packages[0]["ModelPackageArn"])
+        return package["InferenceSpecification"]["Containers"][0][
+            "ModelDataUrl"]
+    except ClientError as e:
+        logger.info(
+            f"No previous model for {model_package_group_name}: "
+            f"{e.response['Error']['Message']}")
+        return None
+
 
 def get_session(region, default_bucket):
     """Gets the sagemaker session based on the region.
@@ -78,6 +201,9 @@ def get_pipeline(
     model_package_group_name="sts-sklearn-grp",
     pipeline_name="stsPipeline",
     base_job_prefix="sts",
+    incremental_training=False,
+    use_spot_training=False,
+    spot_max_wait=172800,
 ) -> Pipeline:
     """Gets a SageMaker ML Pipeline instance working with on sts data.
 
@@ -85,6 +211,15 @@ def get_pipeline(
         region: AWS region to create and run the pipeline.
         role: IAM role to create and run steps and pipeline.
         default_bucket: the bucket to use for storing the artifacts
+        incremental_training: the TrainingMode parameter defaults to
+            incremental and the training step gets the latest approved model
+            to start from, the step is then not cached from one registration
+            to the next
+        use_spot_training: train on managed spot instances, with checkpoints
+            in S3 so that an interrupted training job resumes, see
+            training.py --checkpoint-dir
+        spot_max_wait: the maximum seconds of a spot training job, waiting
+            for spot instances included
 
     Returns:
         an instance of a pipeline
@@ -123,6 +258,42 @@ def get_pipeline(
     model_approval_status = ParameterString(
         name="ModelApprovalStatus", default_value="Approved"
     )
+    # the 99th percentile of the single row predict latency, in milliseconds,
+    # for the model to be registered, see evaluate.py
+    latency_budget = ParameterFloat(
+        name="LatencyBudgetMs", default_value=100.0
+    )
+
+    # batch, incremental, search or tournament, see training.py --mode
+    training_mode = ParameterString(
+        name="TrainingMode",
+        default_value="incremental" if incremental_training else "batch"
+    )
+
+    # a new value runs again the cached steps, see the module docstring
+    cache_refresh_token = ParameterString(
+        name="CacheRefreshToken", default_value="0"
+    )
+    # the version of the object at InputDataUrl, e.g. its ETag, a changed
+    # dataset is not taken from the cache, see trainmodel.py
+    input_data_version = ParameterString(
+        name="InputDataVersion", default_value="unknown"
+    )
+    cache_config = CacheConfig(
+        enable_caching=True, expire_after=CACHE_EXPIRE_AFTER)
+    cache_env = {
+        "STS_CACHE_REFRESH_TOKEN": cache_refresh_token,
+        "STS_INPUT_DATA_VERSION": input_data_version,
+    }
+
+    # the code of the steps, uploaded once per content
+    code = {
+        name: upload_code(
+            os.path.join(BASE_DIR, name), sagemaker_session, base_job_prefix)
+        for name in [
+            "preprocess.py", "transform.py", "splits.py", "inference.py",
+            "evaluate.py"]
+    }
 
     # preprocess 
 
@@ -131,6 +302,26 @@ def get_pipeline(
         name="InputDataUrl",
         default_value=f"s3://sts-datwit-dataset/stsmsrpc.txt",
     )
+    # processes computing the features on each processing instance,
+    # "0" uses all the instance vCPUs
+    processing_workers = ParameterString(
+        name="ProcessingWorkers", default_value="0"
+    )
+    # comma separated distance metrics used as features, see
+    # preprocess._VALID_METRICS_
+    feature_metrics = ParameterString(
+        name="FeatureMetrics", default_value="all"
+    )
+    # format of the train, validation and test splits, "npy" or "csv"
+    split_format = ParameterString(
+        name="SplitFormat", default_value="npy"
+    )
+
+    # features computed by previous runs, only the new or changed pairs of
+    # the input are computed again
+    feature_store_uri = (
+        f"s3://{sagemaker_session.default_bucket()}/{base_job_prefix}/feature-store"
+    )
 
     # processing step for feature engineering
     sklearn_processor = SKLearnProcessor(
@@ -138,13 +329,66 @@ def get_pipeline(
         instance_type=processing_instance_type,
         instance_count=processing_instance_count,
         base_job_name=f"{base_job_prefix}/sklearn-sts-preprocess",
+        env=cache_env,
         sagemaker_session=sagemaker_session,
         role=role,
     )
 
+    # each processing instance computes the features of its own shard of
+    # the input, see preprocess --stage
     step_preprocess = ProcessingStep(
         name="PreprocessSTSData",
         processor=sklearn_processor,
+        inputs=[
+            ProcessingInput(
+                source=code["transform.py"],
+                destination="/opt/ml/processing/input/transform",
+            ),
+        ],
+        outputs=[
+            ProcessingOutput(output_name="shards",
+                            source="/opt/ml/processing/shards"),
+            ProcessingOutput(output_name="report",
+                            source="/opt/ml/processing/report"),
+        ],
+        code=code["preprocess.py"],
+        job_arguments=[
+            "--input-data", input_data,
+            "--input-data-version", input_data_version,
+            "--stage", "features",
+            "--workers", processing_workers,
+            "--feature-store", feature_store_uri,
+            "--metrics", feature_metrics,
+        ],
+        cache_config=cache_config,
+    )
+
+    # merge of the shards in the train, validation and test splits
+    sklearn_merge_processor = SKLearnProcessor(
+        framework_version="0.23-1",
+        instance_type=processing_instance_type,
+        instance_count=1,
+        base_job_name=f"{base_job_prefix}/sklearn-sts-merge",
+        env=cache_env,
+        sagemaker_session=sagemaker_session,
+        role=role,
+    )
+
+    step_merge = ProcessingStep(
+        name="MergeSTSData",
+        processor=sklearn_merge_processor,
+        inputs=[
+            ProcessingInput(
+                source=step_preprocess.properties.ProcessingOutputConfig.Outputs[
+                    "shards"
+                ].S3Output.S3Uri,
+                destination="/opt/ml/processing/shards",
+            ),
+            ProcessingInput(
+                source=code["transform.py"],
+                destination="/opt/ml/processing/input/transform",
+            ),
+        ],
         outputs=[
             ProcessingOutput(output_name="train",
                             source="/opt/ml/processing/train"),
@@ -152,9 +396,17 @@ def get_pipeline(
                             source="/opt/ml/processing/validation"),
             ProcessingOutput(output_name="test",
                             source="/opt/ml/processing/test"),
+            ProcessingOutput(output_name="feature-store",
+                            source="/opt/ml/processing/feature-store",
+                            destination=feature_store_uri),
+        ],
+        code=code["preprocess.py"],
+        job_arguments=[
+            "--stage", "merge",
+            "--feature-store", feature_store_uri,
+            "--split-format", split_format,
         ],
-        code=os.path.join(BASE_DIR, "preprocess.py"),
-        job_arguments=["--input-data", input_data],
+        cache_config=cache_config,
     )
 
     # training step for generating model artifacts
@@ -167,7 +419,24 @@ def get_pipeline(
         instance_type=training_instance_type,
     )
 
-    sklearn_estimator = SKLearn(
+    # the SDK only takes a bool for use_spot_instances, not a pipeline
+    # parameter, the spot training is chosen when the pipeline is defined.
+    # The checkpoints uri is the same for every execution, training.py only
+    # resumes a checkpoint of the same data and hyperparameters and clears
+    # it once the model is saved. An execution scoped uri would change the
+    # step arguments, hence its cache key, on every execution
+    spot_args = {}
+    if use_spot_training:
+        spot_args = dict(
+            use_spot_instances=True,
+            max_run=24 * 60 * 60,
+            max_wait=spot_max_wait,
+            checkpoint_s3_uri=(
+                f"s3://{sagemaker_session.default_bucket()}/"
+                f"{base_job_prefix}/checkpoints"),
+        )
+
+    sklearn_estimator = CachedSKLearn(
         entry_point='training.py',
         source_dir=BASE_DIR,
         instance_type=training_instance_type,
@@ -176,35 +445,54 @@ def get_pipeline(
         framework_version="0.23-1",
         py_version="py3",
         base_job_name=f"{base_job_prefix}/sts-train",
+        # the tournament winner is selected within the registration budget,
+        # as a string as all the environment variables
+        environment=dict(
+            cache_env, STS_TRAINING_MODE=training_mode,
+            STS_LATENCY_BUDGET_MS=Join(on="", values=[latency_budget])),
         sagemaker_session=sagemaker_session,
-        role=role,)
+        role=role,
+        **spot_args)
+
+    # the incremental training starts from the last registered model. Only
+    # given to the incremental training: a new model in the group changes
+    # the step inputs, and so its cache key
+    training_inputs = {}
+    previous_model_data = None
+    if incremental_training:
+        previous_model_data = get_latest_model_data(
+            sagemaker_session, model_package_group_name)
+    if previous_model_data is not None:
+        training_inputs["model"] = TrainingInput(s3_data=previous_model_data)
 
     step_train = TrainingStep(
         name="TrainSTSModel",
         estimator=sklearn_estimator,
         inputs={
             "train": TrainingInput(
-                s3_data=step_preprocess.properties.ProcessingOutputConfig.Outputs[
+                s3_data=step_merge.properties.ProcessingOutputConfig.Outputs[
                     "train"
                 ].S3Output.S3Uri,
-                content_type="text/csv",
             ),
             "validation": TrainingInput(
-                s3_data=step_preprocess.properties.ProcessingOutputConfig.Outputs[
+                s3_data=step_merge.properties.ProcessingOutputConfig.Outputs[
                     "validation"
                 ].S3Output.S3Uri,
-                content_type="text/csv",
             ),
+            **training_inputs,
         },
+        cache_config=cache_config,
     )
 
-    # processing step for evaluation
+    # processing step for evaluation and for the model quality monitoring
+    # baseline data, the model is loaded once for both, see evaluate.py
     script_eval = ScriptProcessor(
         image_uri=image_uri,
         command=["python3"],
         instance_type=processing_instance_type,
         instance_count=1,
         base_job_name=f"{base_job_prefix}/script-sts-eval",
+        env=cache_env,
         sagemaker_session=sagemaker_session,
         role=role,
     )
@@ -222,60 +510,52 @@ def get_pipeline(
                 destination="/opt/ml/processing/model",
             ),
             ProcessingInput(
-                source=step_preprocess.properties.ProcessingOutputConfig.Outputs[
+                source=step_merge.properties.ProcessingOutputConfig.Outputs[
                     "test"
                 ].S3Output.S3Uri,
                 destination="/opt/ml/processing/test",
             ),
-        ],
-        outputs=[
-            ProcessingOutput(output_name="evaluation",
-                            source="/opt/ml/processing/evaluation"),
-        ],
-        code=os.path.join(BASE_DIR, "evaluate.py"),
-        property_files=[evaluation_report],
-    )
-
-        # setup model quality monitoring baseline data
-    script_process_baseline_data = ScriptProcessor(
-        image_uri=image_uri,
-        command=["python3"],
-        instance_type=processing_instance_type,
-        instance_count=1,
-        base_job_name=f"{base_job_prefix}/baseline",
-        sagemaker_session=sagemaker_session,
-        role=role,
-    )
-
-    step_proccess_baseline_data = ProcessingStep(
-        name="SetupMonitoringData",
-        processor=script_process_baseline_data,
-        inputs=[
-            ProcessingInput(
-                source=step_train.properties.ModelArtifacts.S3ModelArtifacts,
-                destination="/opt/ml/processing/model",
-            ),
             ProcessingInput(
-                source=step_preprocess.properties.ProcessingOutputConfig.Outputs[
+                source=step_merge.properties.ProcessingOutputConfig.Outputs[
                     "validation"
                 ].S3Output.S3Uri,
                 destination="/opt/ml/processing/validation",
             ),
+            ProcessingInput(
+                source=code["splits.py"],
+                destination="/opt/ml/processing/input/splits",
+            ),
+            ProcessingInput(
+                source=code["inference.py"],
+                destination="/opt/ml/processing/input/inference",
+            ),
         ],
         outputs=[
+            ProcessingOutput(output_name="evaluation",
+                            source="/opt/ml/processing/evaluation"),
             ProcessingOutput(output_name="validate",
-                             source="/opt/ml/processing/validate"),
+                            source="/opt/ml/processing/validate"),
         ],
-        code=os.path.join(BASE_DIR, "baseline.py")
+        code=code["evaluate.py"],
+        job_arguments=[
+            "--evaluation-split", "test",
+            "--baseline-split", "validation",
+        ],
+        property_files=[evaluation_report],
+        cache_config=cache_config,
     )
-    # ---
 
-    # register model step that will be conditionally executed
+    # register model step that will be conditionally executed, the
+    # evaluation uri is the one of the execution the step outputs come from,
+    # a previous one when the step is taken from the cache
     model_metrics = ModelMetrics(
         model_statistics=MetricsSource(
-            s3_uri="{}/evaluation.json".format(
-                step_eval.arguments["ProcessingOutputConfig"]["Outputs"][0]["S3Output"]["S3Uri"]
-            ),
+            s3_uri=Join(on="/", values=[
+                step_eval.properties.ProcessingOutputConfig.Outputs[
+                    "evaluation"
+                ].S3Output.S3Uri,
+                "evaluation.json",
+            ]),
             content_type="application/json"
         )
     )
@@ -302,11 +582,18 @@ def get_pipeline(
         ),
         right=6.0,
     )
+    cond_latency = ConditionLessThanOrEqualTo(
+        left=JsonGet(
+            step=step_eval,
+            property_file=evaluation_report,
+            json_path="latency_metrics.predict_p99_ms.value"
+        ),
+        right=latency_budget,
+    )
     step_cond = ConditionStep(
         name="CheckMSESTSEvaluation",
-        conditions=[cond_lte],
-        if_steps=[step_register, step_proccess_baseline_data],
-        # if_steps=[step_register],
+        conditions=[cond_lte, cond_latency],
+        if_steps=[step_register],
         else_steps=[],
     )
 
@@ -318,9 +605,16 @@ def get_pipeline(
             processing_instance_count,
             training_instance_type,
             model_approval_status,
+            latency_budget,
+            training_mode,
             input_data,
+            input_data_version,
+            processing_workers,
+            feature_metrics,
+            split_format,
+            cache_refresh_token,
         ],
-        steps=[step_preprocess, step_train, step_eval, step_cond],
+        steps=[step_preprocess, step_merge, step_train, step_eval, step_cond],
         sagemaker_session=sagemaker_session,
     )
     return pipeline
@@ -2,17 +2,31 @@
 
 import os
 import csv
+import json
 import pickle
 import string
+import hashlib
+import time
+import tracemalloc
+import functools
 import pathlib
+import shutil
+import sys
 import boto3
 import logging
 import argparse
 import warnings
 import numpy as np
+from array import array
+from collections import deque
+from itertools import islice, repeat
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from sklearn.preprocessing import MaxAbsScaler
-from sklearn.metrics.pairwise import * #support sparse matrix inputs
-from scipy.spatial.distance import * #do not support sparse matrix inputs
+from scipy import sparse
+
+# transform.py is given to the processing job as an input, see pipeline.py
+sys.path.insert(0, "/opt/ml/processing/input/transform")
+from transform import fit_imputation, impute, save_statistics, scale_rows
 
 warnings.filterwarnings(action='ignore')
 
@@ -21,170 +35,1153 @@ logger.setLevel(logging.INFO)
 logger.addHandler(logging.StreamHandler())
 
 # helper functions
-def count_words(list_of_words):
-    """"""
-    corpus_dict = {}
-    for w in list_of_words:
-        corpus_dict[w] = corpus_dict.get(w, 0.0) + 1.0
-        
-    return corpus_dict
-
-def CountVectorizer(string_dict, set_both_strings):
-    """Whit padding included""" 
-    vector = []
-    for key in set_both_strings: 
-        if key in string_dict: 
-            vector.append(int(string_dict[key])) 
-        else:
-            vector.append(0)
-    return vector
+_VALID_METRICS_ = ['euclidean', 'l2', 'l1', 'manhattan', 'cityblock',
+    'braycurtis', 'canberra', 'chebyshev', 'correlation',
+    'cosine', 'dice', 'hamming', 'jaccard', 'kulsinski',
+    'matching', 'minkowski', 'rogerstanimoto',
+    'russellrao', 'seuclidean', 'sokalmichener',
+    'sokalsneath', 'sqeuclidean', 'yule',]
+_SPLITS_ = ("train", "validation", "test")
+# bump when the features computation changes, invalidates the stored ones
+# 2: the store keeps the distances, before the scaling
+# 3: the pairs are looked up by the sorted hashes of their IDs
+_FEATURE_STORE_VERSION_ = 3
+_FEATURE_STORE_FILES_ = [
+    "meta.json", "key.npy", "digest.npy", "row.npy", "features.npy"]
+# the columns of a shard and their dtypes, appended chunk by chunk to
+# <name>.bin files while the features are computed, see `open_shard`
+_SHARD_COLUMNS_ = {
+    "features": np.float32, "key": np.uint64, "digest": np.uint64,
+    "assignment": np.uint8}
+_PUNCTUATION_TABLE_ = str.maketrans("", "", string.punctuation)
+# corpus wide vocabulary, word -> id, shared by all the pairs of a process
+_VOCABULARY_ = {}
+# distinct sentences kept tokenized, see `sentence_ids`
+_SENTENCE_CACHE_SIZE_ = 2 ** 18
+# bytes of the input fetched by a ranged GET
+_DOWNLOAD_BLOCK_SIZE_ = 8 * 2 ** 20
+
+
+def tokenize(sentence):
+    """Remove the punctuation from a sentence and split it in words."""
+    return sentence.translate(_PUNCTUATION_TABLE_).split()
+
+
+@functools.lru_cache(maxsize=_SENTENCE_CACHE_SIZE_)
+def sentence_ids(sentence):
+    """Tokenizes a sentence into interned word ids.
+
+    Words are interned in `_VOCABULARY_` and the result is memoized with a
+    bounded LRU cache, as the same sentences repeat across many pairs.
+
+    Args:
+        sentence: the sentence string
+
+    Returns:
+        the word ids as packed int32 `bytes`, 4 bytes per word
+    """
+    return array(
+        'i',
+        [_VOCABULARY_.setdefault(w, len(_VOCABULARY_))
+         for w in tokenize(sentence)]).tobytes()
+
+
+def count_matrices(sentences):
+    """Build the word count matrices for a list of sentence pairs.
+
+    Each distinct sentence is tokenized once over the corpus vocabulary, see
+    `sentence_ids`, row i of each matrix holds the word counts of the i-th
+    left/right sentence.
+
+    Args:
+        sentences: list of (sentence 1, sentence 2) tuples
+
+    Returns:
+        a tuple of two `scipy.sparse.csr_matrix` (left, right) of shape
+        (number of pairs, vocabulary size)
+    """
+    matrices = []
+    for side in range(2):
+        ids = [sentence_ids(pair[side]) for pair in sentences]
+        indptr = np.zeros(len(ids) + 1, dtype=np.int64)
+        np.cumsum([len(i) // 4 for i in ids], out=indptr[1:])
+        indices = np.frombuffer(bytearray(b"".join(ids)), dtype=np.int32)
+        matrices.append(
+            (np.ones(len(indices), dtype=np.float64), indices, indptr))
+
+    shape = (len(sentences), len(_VOCABULARY_))
+    left, right = [sparse.csr_matrix(m, shape=shape) for m in matrices]
+    # duplicated (row, word) entries are summed up to the word count
+    left.sum_duplicates()
+    right.sum_duplicates()
+    return left, right
+
+
+def _row_sum(matrix):
+    return np.asarray(matrix.sum(axis=1)).ravel()
+
+
+def _canberra_sum(abs_difference, total):
+    # words not in the union have no stored value and contribute with 0
+    terms = abs_difference.multiply(total.power(-1)).tocsr()
+    # add the terms of each row in value order, so the result does not
+    # depend on the vocabulary order, ie. on how the corpus was chunked
+    rows = np.repeat(np.arange(terms.shape[0]), np.diff(terms.indptr))
+    terms.data = terms.data[np.lexsort((terms.data, rows))]
+    return _row_sum(terms)
+
+
+def _correlation(dot, sum_left, sum_right, sq_left, sq_right, n):
+    uv = dot - sum_left * sum_right / n
+    uu = sq_left - sum_left ** 2 / n
+    vv = sq_right - sum_right ** 2 / n
+    return np.abs(1.0 - uv / np.sqrt(uu * vv))
+
+
+def _cosine(dot, sq_left, sq_right):
+    norms = np.sqrt(sq_left * sq_right)
+    # sklearn consider a zero vector orthogonal to every vector
+    similarity = np.divide(
+        dot, norms, out=np.zeros_like(dot), where=norms != 0)
+    return np.clip(1.0 - similarity, 0.0, 2.0)
+
+
+def _seuclidean(different, n):
+    # the variance of a word over a pair of counts is (u - v)^2 / 2, each
+    # different word adds 2, any equal word adds 0 / 0
+    return np.where(different == n, np.sqrt(2.0 * different), np.nan)
+
+
+def _yule(tf, ft):
+    # FF is 0, every word of the pair is in one of its sentences, the
+    # distance is 2 or 0 / 0 when a sentence has no word out of the other.
+    # 0 / 0 is NaN, as the yule of sklearn 0.23 that the features were
+    # computed with, imputed by the merge stage; scipy and later sklearn
+    # versions give 0
+    return np.where(tf * ft != 0, 2.0, np.nan)
+
+
+def word_presence(matrix):
+    """Returns the word presence (bool) matrix of a word count matrix.
+
+    The boolean metrics only need which words are in each sentence, the
+    presence matrix shares the index arrays of the counts matrix and stores
+    one byte per word instead of a float64 count.
+    """
+    return sparse.csr_matrix(
+        (np.ones(matrix.nnz, dtype=np.bool_), matrix.indices, matrix.indptr),
+        shape=matrix.shape)
+
+
+# Intermediate statistics shared by the metrics, computed over the word count
+# matrices of the left and right sentences:
+# name: (statistics it depends on, function(left, right, *dependencies))
+# Each pair of sentences is compared over the union of its words (as the per
+# pair `CountVectorizer` did), so there are never FF positions and the boolean
+# counts are TT, TF and FT.
+_STATISTICS_ = {
+    # sparse matrices
+    'difference': ((), lambda left, right: left - right),
+    'abs_difference': (('difference',), lambda left, right, d: abs(d)),
+    'product': ((), lambda left, right: left.multiply(right)),
+    'total': ((), lambda left, right: left + right),
+    # one value per row
+    'sum_left': ((), lambda left, right: _row_sum(left)),
+    'sum_right': ((), lambda left, right: _row_sum(right)),
+    'sq_left': ((), lambda left, right: _row_sum(left.power(2))),
+    'sq_right': ((), lambda left, right: _row_sum(right.power(2))),
+    'dot': (('product',), lambda left, right, p: _row_sum(p)),
+    'l1': (('abs_difference',), lambda left, right, d: _row_sum(d)),
+    'sq_difference': (
+        ('difference',), lambda left, right, d: _row_sum(d.power(2))),
+    'max_difference': (
+        ('abs_difference',),
+        lambda left, right, d: d.max(axis=1).toarray().ravel()),
+    'different': (('difference',), lambda left, right, d: d.getnnz(axis=1)),
+    'canberra_sum': (
+        ('abs_difference', 'total'),
+        lambda left, right, d, t: _canberra_sum(d, t)),
+    'tt': (
+        (),
+        lambda left, right: word_presence(left).multiply(
+            word_presence(right)).getnnz(axis=1)),
+    'tf': (('tt',), lambda left, right, tt: left.getnnz(axis=1) - tt),
+    'ft': (('tt',), lambda left, right, tt: right.getnnz(axis=1) - tt),
+    'n': (('tt', 'tf', 'ft'), lambda left, right, tt, tf, ft: tt + tf + ft),
+}
+
+# name: (statistics it depends on, function(*statistics))
+_DISTANCE_FORMULAS_ = {
+    'sqeuclidean': (('sq_difference',), lambda sq: sq),
+    'euclidean': (('sq_difference',), np.sqrt),
+    'cityblock': (('l1',), lambda l1: l1),
+    'braycurtis': (
+        ('l1', 'sum_left', 'sum_right'),
+        lambda l1, sum_left, sum_right: l1 / (sum_left + sum_right)),
+    'canberra': (('canberra_sum',), lambda canberra: canberra),
+    'chebyshev': (('max_difference',), lambda max_difference: max_difference),
+    'correlation': (
+        ('dot', 'sum_left', 'sum_right', 'sq_left', 'sq_right', 'n'),
+        _correlation),
+    'cosine': (('dot', 'sq_left', 'sq_right'), _cosine),
+    'hamming': (('different', 'n'), lambda different, n: different / n),
+    'dice': (
+        ('tt', 'tf', 'ft'),
+        lambda tt, tf, ft: (tf + ft) / (2.0 * tt + tf + ft)),
+    'jaccard': (('tf', 'ft', 'n'), lambda tf, ft, n: (tf + ft) / n),
+    'kulsinski': (
+        ('tt', 'tf', 'ft', 'n'),
+        lambda tt, tf, ft, n: (tf + ft - tt + n) / (tf + ft + n)),
+    'rogerstanimoto': (
+        ('tt', 'tf', 'ft'),
+        lambda tt, tf, ft: 2.0 * (tf + ft) / (tt + 2.0 * (tf + ft))),
+    'russellrao': (('tt', 'n'), lambda tt, n: (n - tt) / n),
+    # 2 * TF * FT / (TT * FF + TF * FT), see `_yule`
+    'yule': (('tf', 'ft'), lambda tf, ft: _yule(tf, ft)),
+    'seuclidean': (('different', 'n'), _seuclidean),
+}
+
+# metrics that give the same values as other metric: sklearn aliases,
+# minkowski uses p=2, and without FF positions matching is jaccard and
+# sokalmichener and sokalsneath are rogerstanimoto
+_METRIC_ALIASES_ = {
+    'l2': 'euclidean',
+    'minkowski': 'euclidean',
+    'l1': 'cityblock',
+    'manhattan': 'cityblock',
+    'matching': 'jaccard',
+    'sokalmichener': 'rogerstanimoto',
+    'sokalsneath': 'rogerstanimoto',
+}
+
+
+def plan_metrics(metrics):
+    """Plans the computation of a list of metrics.
+
+    Args:
+        metrics: list of metric names, see `_METRIC_ALIASES_` and
+            `_DISTANCE_FORMULAS_`
+
+    Returns:
+        a tuple of the list of the distinct metrics to compute, and the list
+        of statistics they need in computation order (dependencies first)
+    """
+    formulas = []
+    for metric in metrics:
+        metric = _METRIC_ALIASES_.get(metric, metric)
+        if metric not in _DISTANCE_FORMULAS_:
+            raise ValueError(f"Unknown metric: {metric}")
+        if metric not in formulas:
+            formulas.append(metric)
+
+    statistics = []
+
+    def add(name):
+        if name not in statistics:
+            for dependency in _STATISTICS_[name][0]:
+                add(dependency)
+            statistics.append(name)
+
+    # n is always needed to find the empty pairs
+    add('n')
+    for metric in formulas:
+        for name in _DISTANCE_FORMULAS_[metric][0]:
+            add(name)
+    return formulas, statistics
+
+
+def _measure(profile, name, function, *args):
+    """Calls function, adding its time and memory peak to profile[name]."""
+    if profile is None:
+        return function(*args)
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        return function(*args)
+    finally:
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        cost = profile.setdefault(name, {"seconds": 0.0, "peak_bytes": 0})
+        cost["seconds"] += seconds
+        cost["peak_bytes"] = max(cost["peak_bytes"], peak)
+
+
+def row_distances(left, right, metrics, profile=None):
+    """Computes the distances between each pair of rows of two matrices.
+
+    Gives the same values as calling `pairwise_distances_argmin_min` with
+    the count vectors of every pair (sklearn converts the boolean metrics
+    inputs to bool, minkowski uses p=2 and seuclidean the variance of the
+    pair), but works over all the pairs at once. Each intermediate statistic
+    is computed once and shared by all the metrics using it, see
+    `plan_metrics`.
+
+    Args:
+        left: sparse word counts of the first sentences
+        right: sparse word counts of the second sentences
+        metrics: list of metric names, see `plan_metrics`
+        profile: optional dict, the time and memory peak of each statistic
+            and formula are added to it, see `metrics_report`
+
+    Returns:
+        a `numpy.ndarray` of shape (number of pairs, number of metrics),
+        the rows of a pair of empty sentences are NaN
+    """
+    formulas, plan = plan_metrics(metrics)
+    distances = np.empty((left.shape[0], len(metrics)), dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        statistics = {}
+        for name in plan:
+            dependencies, function = _STATISTICS_[name]
+            statistics[name] = _measure(
+                profile, name, function,
+                left, right, *(statistics[d] for d in dependencies))
+        values = {}
+        for metric in formulas:
+            dependencies, function = _DISTANCE_FORMULAS_[metric]
+            values[metric] = _measure(
+                profile, metric, function,
+                *(statistics[d] for d in dependencies))
+    for i, metric in enumerate(metrics):
+        distances[:, i] = values[_METRIC_ALIASES_.get(metric, metric)]
+    distances[statistics['n'] == 0] = np.nan
+    return distances
+
+
+def metrics_report(profile, metrics, rows):
+    """Builds the per metric cost report of a profiled `row_distances` run.
+
+    Args:
+        profile: the dict filled by `row_distances`
+        metrics: list of metric names given to `row_distances`
+        rows: number of pairs profiled
+
+    Returns:
+        a dict, for each metric: the formula it is computed with, the
+        statistics it needs, its seconds and memory peak computed alone and
+        its marginal seconds, ie. the time saved by not computing it (the
+        statistics shared with other metrics are still needed)
+    """
+    formulas, _ = plan_metrics(metrics)
+    needs = {}
+    for formula in formulas:
+        _, statistics = plan_metrics([formula])
+        needs[formula] = [formula] + statistics
+    report = {"rows": rows, "metrics": {}}
+    for metric in metrics:
+        formula = _METRIC_ALIASES_.get(metric, metric)
+        shared = set().union(*(
+            needs[other] for other in formulas if other != formula))
+        steps = needs[formula]
+        report["metrics"][metric] = {
+            "formula": formula,
+            "statistics": steps[1:],
+            "seconds": sum(profile[s]["seconds"] for s in steps),
+            "marginal_seconds": sum(
+                profile[s]["seconds"] for s in steps if s not in shared),
+            "peak_bytes": max(profile[s]["peak_bytes"] for s in steps),
+        }
+    return report
+
+
+def _chunk_distances(sentences, metrics):
+    left, right = count_matrices(sentences)
+    return row_distances(left, right, metrics)
+
+
+def compute_distances(sentences, metrics, workers=1, executor=None):
+    """Computes the distances of the sentence pairs, optionally in parallel.
+
+    With more than one worker the sentences are split in chunks that are
+    processed by a pool of processes, the results are merged back in the
+    same order of `sentences`.
+
+    Args:
+        sentences: list of (sentence 1, sentence 2) tuples
+        metrics: list of metric names, see `plan_metrics`
+        workers: number of processes, 0 or less to use all the CPUs
+        executor: a running `ProcessPoolExecutor` of `workers` processes to
+            use instead of starting a new one
+
+    Returns:
+        a `numpy.ndarray` of shape (number of pairs, number of metrics)
+    """
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    if workers == 1 or len(sentences) < 2:
+        return _chunk_distances(sentences, metrics)
+    if executor is None:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            return compute_distances(sentences, metrics, workers, executor)
+
+    # a few chunks per worker, so a slow chunk does not idle the others
+    chunk_size = -(-len(sentences) // (4 * workers))
+    chunks = [
+        sentences[i:i + chunk_size]
+        for i in range(0, len(sentences), chunk_size)]
+    logger.debug(
+        "Computing distances in %d chunks with %d workers.",
+        len(chunks), workers)
+    # map returns the results in the order of the chunks
+    distances = list(executor.map(
+        _chunk_distances, chunks, repeat(metrics, len(chunks))))
+    return np.concatenate(distances)
+
+
+def read_chunks(lines, chunk_size, header=True):
+    """Reads the sts dataset in chunks of rows.
+
+    Expected format is (tab separated, with a header row):
+    Quality ID#1 ID#2 String#1 String#2
+
+    Args:
+        lines: iterable of the dataset lines, an open file or the lines
+            streamed from S3, see `iter_shard_lines`
+        chunk_size: maximum number of rows in a chunk
+        header: whether the lines start with the header row, only the first
+            shard of the dataset does
+
+    Yields:
+        (ids, sentences, y) tuples of lists, ids are (ID#1, ID#2) tuples,
+        the malformed rows are skipped
+    """
+    csv_reader = csv.reader(lines, delimiter='\t')
+    if header:
+        # skip first (header) row
+        next(csv_reader, None)
+    ids, sentences, y = [], [], []
+    for row in csv_reader:
+        try:
+            label = float(row[0])
+            pair = (row[3], row[4])
+        except (IndexError, ValueError):
+            continue
+        ids.append((row[1], row[2]))
+        sentences.append(pair)
+        y.append(label)
+        if len(y) == chunk_size:
+            yield ids, sentences, y
+            ids, sentences, y = [], [], []
+    if y:
+        yield ids, sentences, y
+
+
+def host_rank(config="/opt/ml/config/resourceconfig.json"):
+    """Returns the rank of this host and the number of hosts of the job.
+
+    The hosts are ranked by name, the processing config lists them as
+    algo-1, algo-2... A host outside of a processing job is the only one.
+    """
+    try:
+        with open(config) as f:
+            resource = json.load(f)
+    except FileNotFoundError:
+        return 0, 1
+    hosts = sorted(resource["hosts"])
+    return hosts.index(resource["current_host"]), len(hosts)
+
+
+def shard_range(size, rank, n_hosts):
+    """Returns the [start, end) byte range of the input read by a host."""
+    return size * rank // n_hosts, size * (rank + 1) // n_hosts
+
+
+def range_reader(input_data):
+    """Returns the size of the input and a function reading a byte range.
+
+    Args:
+        input_data: S3 uri of the input, or the path of a local file, e.g.
+            for a local run of the pipeline
+
+    Returns:
+        a tuple (size, read_range), read_range(first, last) returns the
+        bytes from first to last included, it can be called from several
+        threads at once
+    """
+    if not input_data.startswith("s3://"):
+        def read_range(first, last):
+            with open(input_data, "rb") as f:
+                f.seek(first)
+                return f.read(last - first + 1)
+
+        return os.path.getsize(input_data), read_range
+
+    bucket = input_data.split("/")[2]
+    key = "/".join(input_data.split("/")[3:])
+    # boto3 clients can be shared by threads
+    client = boto3.client("s3")
+
+    def read_range(first, last):
+        response = client.get_object(
+            Bucket=bucket, Key=key, Range=f"bytes={first}-{last}")
+        return response["Body"].read()
+
+    return client.head_object(Bucket=bucket, Key=key)["ContentLength"], (
+        read_range)
+
+
+def iter_blocks(read_range, start, end, block_size, concurrency):
+    """Yields the bytes [start, end) of the input, in order, by blocks.
+
+    The blocks are fetched by parallel ranged GETs, up to concurrency blocks
+    ahead of the one yielded, so the download goes on while the caller
+    works on the previous blocks.
+
+    Args:
+        read_range: the function reading a byte range, see `range_reader`
+        start: the first byte
+        end: the byte after the last one
+        block_size: bytes fetched by a GET
+        concurrency: the number of GETs running at once
+    """
+    def get(first):
+        return read_range(first, min(first + block_size, end) - 1)
+
+    offsets = iter(range(start, end, block_size))
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = deque(
+            executor.submit(get, first)
+            for first in islice(offsets, concurrency))
+        try:
+            while futures:
+                block = futures.popleft().result()
+                for first in islice(offsets, 1):
+                    futures.append(executor.submit(get, first))
+                yield block
+        finally:
+            # the caller stopped early, e.g. at the end of its shard
+            for future in futures:
+                future.cancel()
+
+
+def iter_shard_lines(input_data, rank=0, n_hosts=1,
+                     block_size=_DOWNLOAD_BLOCK_SIZE_, concurrency=4):
+    """Yields the lines of the input that start in the host byte range.
+
+    Every line starts in the range of exactly one host, so the hosts read
+    disjoint shards covering the whole input. The last line of a shard is
+    read past the end of the range.
+
+    Args:
+        input_data: S3 uri of the input, or the path of a local file
+        rank: the host rank, see `host_rank`
+        n_hosts: the number of hosts
+        block_size: bytes fetched by a GET, see `iter_blocks`
+        concurrency: the number of GETs running at once
+
+    Yields:
+        the lines as bytes, with their line break
+    """
+    size, read_range = range_reader(input_data)
+    start, end = shard_range(size, rank, n_hosts)
+    if start == end:
+        return
+    # the byte before the range tells if a line starts on its first byte,
+    # the line read up to the first line break is the previous host one
+    position = max(start - 1, 0)
+    skip = start > 0
+    pending = b""
+    for block in iter_blocks(
+            read_range, position, size, block_size, concurrency):
+        lines = (pending + block).split(b"\n")
+        pending = lines.pop()
+        for line in lines:
+            line_start, position = position, position + len(line) + 1
+            if skip:
+                skip = False
+            elif line_start >= end:
+                return
+            else:
+                yield line + b"\n"
+    if pending and not skip and position < end:
+        yield pending
+
+
+def download_shard(input_data, filename, rank=0, n_hosts=1, concurrency=4):
+    """Downloads the lines of the input that start in the host byte range.
+
+    Args:
+        input_data: S3 uri of the input, or the path of a local file
+        filename: path of the shard file written
+        rank: the host rank, see `host_rank`
+        n_hosts: the number of hosts
+        concurrency: the number of GETs running at once
+    """
+    with open(filename, "wb") as f:
+        f.writelines(iter_shard_lines(
+            input_data, rank, n_hosts, concurrency=concurrency))
+
+
+def open_shard(path):
+    """Opens the column files of the rows featurized by a host.
+
+    The rows are appended chunk by chunk to one file per column, so that
+    the memory used does not grow with the shard size:
+
+    - features.bin: a float32 C ordered matrix, label in the first column,
+      then the distances, not scaled
+    - key.bin: the uint64 pair keys, see `pair_keys`
+    - digest.bin: the uint64 pair digests, see `pair_digest`
+    - assignment.bin: the uint8 split index of the pairs, see
+      `assign_splits`
+
+    Returns:
+        dict of the column name -> the file open for writing
+    """
+    pathlib.Path(path).mkdir(parents=True, exist_ok=True)
+    return {
+        name: open(os.path.join(path, f"{name}.bin"), "wb")
+        for name in _SHARD_COLUMNS_}
+
+
+def save_shard(path, metrics, n_rows):
+    """Writes the description of the rows featurized by a host.
+
+    Args:
+        path: the shard folder, see `open_shard`
+        metrics: list of metric names of the features columns
+        n_rows: the number of rows of the shard
+    """
+    # written last, a shard interrupted while saving is not valid
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump({"rows": n_rows, "metrics": list(metrics)}, f)
+
+
+def load_shards(path):
+    """Loads the shards featurized by the hosts, in the order of the ranks.
+
+    Args:
+        path: the folder with one part-<rank> folder per host
+
+    Returns:
+        a tuple of the metrics and a list of (keys, digests, rows,
+        assignment) per shard, memory mapped
+    """
+    metrics, shards = None, []
+    for shard_dir in sorted(pathlib.Path(path).glob("part-*")):
+        with open(shard_dir / "meta.json") as f:
+            meta = json.load(f)
+        if metrics is None:
+            metrics = meta["metrics"]
+        elif meta["metrics"] != metrics:
+            raise ValueError(f"{shard_dir} has other features")
+        columns = {}
+        for name, dtype in _SHARD_COLUMNS_.items():
+            shape = (meta["rows"],)
+            if name == "features":
+                shape += (1 + len(metrics),)
+            if meta["rows"]:
+                columns[name] = np.memmap(
+                    shard_dir / f"{name}.bin", dtype=dtype, mode="r",
+                    shape=shape)
+            else:
+                columns[name] = np.empty(shape, dtype=dtype)
+        shards.append((
+            columns["key"], columns["digest"], columns["features"],
+            columns["assignment"]))
+    if metrics is None:
+        raise FileNotFoundError(f"No shard found in {path}")
+    return metrics, shards
+
+
+def iter_shard_blocks(shards, chunk_size):
+    """Iterates the rows of the shards by chunks, in the order of the ranks.
+
+    Args:
+        shards: the shards, see `load_shards`
+        chunk_size: the maximum number of rows of a chunk
+
+    Yields:
+        (start, rows, assignment) the row index of the chunk in the merged
+        shards, its features rows and the split index of its pairs
+    """
+    start = 0
+    for _, _, rows, assignment in shards:
+        for offset in range(0, len(rows), chunk_size):
+            block = rows[offset:offset + chunk_size]
+            yield start, block, assignment[offset:offset + chunk_size]
+            start += len(block)
+
+
+def split_sizes(shards, chunk_size):
+    """Counts the rows of each split in the shards, see `assign_splits`."""
+    counts = np.zeros(len(_SPLITS_), dtype=np.int64)
+    for _, _, assignment in iter_shard_blocks(shards, chunk_size):
+        counts += np.bincount(assignment, minlength=len(_SPLITS_))
+    return counts
+
+
+def assign_splits(keys, train=0.7, validation=0.15):
+    """Assigns the pairs to the train, validation and test splits.
+
+    The split of a pair only depends on the hash of its IDs, the same pair
+    is always in the same split and the fractions of the splits are close
+    to the expected ones.
+
+    Args:
+        keys: the pair keys, the hashes of their IDs, see `pair_keys`
+        train: expected fraction of pairs in train
+        validation: expected fraction of pairs in validation
+
+    Returns:
+        `numpy.ndarray` of the index in `_SPLITS_` of the split of each pair
+    """
+    # the hashes are uniform in [0, 2 ** 64)
+    boundaries = np.array([train, train + validation]) * 2.0 ** 64
+    return np.searchsorted(
+        boundaries, np.asarray(keys, dtype=np.uint64),
+        side="right").astype(np.uint8)
+
+
+def pair_keys(ids):
+    """Hashes the (ID#1, ID#2) pairs in 64 bits keys, see `pair_digest`."""
+    return np.array([pair_digest(pair) for pair in ids], dtype=np.uint64)
+
+
+def pair_digest(pair):
+    """64 bits hash of the content of a sentence pair."""
+    digest = hashlib.blake2b(
+        "\0".join(pair).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+def download_feature_store(s3_uri, path):
+    """Downloads the feature store files under a S3 prefix, if any.
+
+    The store can also be a local folder, e.g. for a local run of the
+    pipeline, it is read in place: the hosts of a local run share the same
+    processing folder and would overwrite the files the others are reading.
+
+    Returns:
+        the folder to load the store from, see `load_feature_store`
+    """
+    if not s3_uri.startswith("s3://"):
+        return s3_uri
+    bucket = s3_uri.split("/")[2]
+    prefix = "/".join(s3_uri.split("/")[3:]).rstrip("/")
+    pathlib.Path(path).mkdir(parents=True, exist_ok=True)
+    s3_bucket = boto3.resource("s3").Bucket(bucket)
+    for obj in s3_bucket.objects.filter(Prefix=prefix + "/"):
+        name = obj.key[len(prefix) + 1:]
+        if name in _FEATURE_STORE_FILES_:
+            s3_bucket.download_file(obj.key, os.path.join(path, name))
+    return path
+
+
+def load_feature_store(path, metrics):
+    """Loads the features computed on a previous run.
+
+    The store is a directory with one file per column: the pair keys,
+    sorted, the pair content digests and the rows of the pairs in the
+    distances matrix, not scaled. All of them are memory mapped, a pair is
+    looked up with a binary search of its key, see `lookup_feature_store`.
+
+    Args:
+        path: the store directory
+        metrics: list of metric names the features must have been computed
+            with, otherwise the store is ignored
+
+    Returns:
+        a tuple (keys, digests, rows, features), None if there is no valid
+        store
+    """
+    try:
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        return None
+    if meta != {"version": _FEATURE_STORE_VERSION_, "metrics": list(metrics)}:
+        logger.info("Ignoring the feature store, it has other features.")
+        return None
+    return tuple(
+        np.load(os.path.join(path, name), mmap_mode="r")
+        for name in ("key.npy", "digest.npy", "row.npy", "features.npy"))
+
+
+def lookup_feature_store(store, keys, digests):
+    """Finds the pairs of a chunk in the feature store.
+
+    Args:
+        store: the store, see `load_feature_store`, or None
+        keys: the keys of the pairs, see `pair_keys`
+        digests: the content digests of the pairs, see `pair_digest`
+
+    Returns:
+        `numpy.ndarray` of the store row of each pair, -1 for the pairs not
+        in the store or whose content changed
+    """
+    stored_rows = np.full(len(keys), -1, dtype=np.int64)
+    if store is None or not len(keys):
+        return stored_rows
+    store_keys, store_digests, store_rows, _ = store
+    if not len(store_keys):
+        return stored_rows
+    positions = np.searchsorted(store_keys, keys)
+    positions[positions == len(store_keys)] = 0
+    found = (
+        (np.asarray(store_keys[positions]) == keys)
+        & (np.asarray(store_digests[positions]) == digests))
+    stored_rows[found] = store_rows[positions[found]]
+    return stored_rows
+
+
+def save_feature_store(path, metrics, keys, digests, features):
+    """Writes the features of this run as the new feature store.
+
+    Args:
+        path: the store directory
+        metrics: list of metric names of the features columns
+        keys: `numpy.ndarray` of the pair keys, see `pair_keys`
+        digests: `numpy.ndarray` of the pair digests, see `pair_digest`
+        features: list of distances matrices, e.g. one per shard, written
+            one after the other
+    """
+    pathlib.Path(path).mkdir(parents=True, exist_ok=True)
+    # sorted by key for the lookups, each key with its row in the features
+    order = np.argsort(keys, kind="stable")
+    np.save(os.path.join(path, "key.npy"), keys[order])
+    np.save(os.path.join(path, "digest.npy"), digests[order])
+    np.save(os.path.join(path, "row.npy"), order.astype(np.int64))
+    del order
+    store_features = np.lib.format.open_memmap(
+        os.path.join(path, "features.npy"), mode="w+", dtype=np.float32,
+        shape=(len(keys), len(metrics)))
+    start = 0
+    for matrix in features:
+        store_features[start:start + len(matrix)] = matrix
+        start += len(matrix)
+    store_features.flush()
+    del store_features
+    # written last, a store interrupted while saving is not valid
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump(
+            {"version": _FEATURE_STORE_VERSION_, "metrics": list(metrics)}, f)
 
-def min_max_range(x, range_values):
-    return [round(((xx-min(x))/(1.0*(max(x)-min(x))))*(range_values[1]-range_values[0])+range_values[0],5) for xx in x]
 
 # main routine
 if __name__ == "__main__":
     logger.debug("Starting preprocessing.")
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("--input-data", type=str, required=True)
+    parser.add_argument(
+        "--input-data", type=str, default=None,
+        help="S3 uri of the dataset, or the path of a local file")
+    parser.add_argument(
+        "--input-data-version", type=str, default=None,
+        help="version of the dataset, e.g. the ETag of the S3 object, only "
+             "logged, part of the pipeline step cache key")
+    parser.add_argument(
+        "--stage", type=str, default="all",
+        choices=["all", "features", "merge"],
+        help="features computes the features of this host shard of the "
+             "input, merge combines the shards of all the hosts in the "
+             "splits, all does both on a single host")
+    parser.add_argument(
+        "--host-rank", type=int, default=None,
+        help="rank of this host, read from the processing config by default")
+    parser.add_argument(
+        "--host-count", type=int, default=None,
+        help="number of hosts, read from the processing config by default")
+    parser.add_argument(
+        "--local-copy", action="store_true",
+        help="download the input to the local disk before reading it, "
+             "instead of reading it while it is downloaded")
+    parser.add_argument(
+        "--download-concurrency", type=int, default=4,
+        help="parallel ranged GETs reading the input")
+    parser.add_argument(
+        "--workers", type=int, default=1,
+        help="processes computing the features, 0 to use all the CPUs")
+    parser.add_argument(
+        "--chunk-size", type=int, default=100000,
+        help="rows read and transformed at once")
+    parser.add_argument(
+        "--feature-store", type=str, default=None,
+        help="S3 uri (or local folder) of the features computed on "
+             "previous runs, only the new or changed pairs are computed")
+    parser.add_argument(
+        "--metrics", type=str, default="all",
+        help="comma separated metrics to use as features, or all")
+    parser.add_argument(
+        "--profile-rows", type=int, default=10000,
+        help="rows of the first chunk used to profile each metric cost, "
+             "0 to disable")
+    parser.add_argument(
+        "--split-format", type=str, default="npy", choices=["npy", "csv"],
+        help="format of the train, validation and test splits, a float32 "
+             "npy matrix or a text csv")
     args = parser.parse_args()
     input_data = args.input_data
+    if args.stage != "merge" and not input_data:
+        parser.error("--input-data is required to compute the features")
 
-    '''
-    Load dataset
+    base_dir = "/opt/ml/processing"
+    shards_dir = f"{base_dir}/shards"
+    store_dir = f"{base_dir}/feature-store"
 
-    Loading txt (csv) file, expected format is:
-    Quality ID#1 ID#2 String#1 String#2
-    Separator is tab (\t) character
-    '''
+    if args.stage in ("all", "features"):
+        '''
+        Load dataset
 
-    base_dir = "/opt/ml/processing"
-    pathlib.Path(f"{base_dir}/data").mkdir(parents=True, exist_ok=True)
-    bucket = input_data.split("/")[2]
-    key = "/".join(input_data.split("/")[3:])
-    # bucket = "sts-demo-datasets"
-    # key = "stsmsrpc.txt"
+        Loading txt (csv) file, expected format is:
+        Quality ID#1 ID#2 String#1 String#2
+        Separator is tab (\t) character
 
-    logger.info("Downloading data from bucket: %s, key: %s", bucket, key)
+        With several hosts each one reads its own shard of the file.
+        '''
 
-    filename = f"{base_dir}/data/{key}"
-    s3_client = boto3.resource("s3")
-    s3_client.Bucket(bucket).download_file(key, filename)
+        rank, n_hosts = host_rank()
+        if args.host_rank is not None:
+            rank = args.host_rank
+        if args.host_count is not None:
+            n_hosts = args.host_count
+        if args.input_data_version:
+            logger.info(
+                "Input data %s, version %s", input_data,
+                args.input_data_version)
 
-    logger.info("Reading downloaded data.")
+        # only the first shard starts with the header row
+        header = rank == 0
+        if args.local_copy:
+            logger.info(
+                "Downloading data from %s, shard %d of %d",
+                input_data, rank + 1, n_hosts)
+            pathlib.Path(f"{base_dir}/data").mkdir(
+                parents=True, exist_ok=True)
+            filename = (
+                f"{base_dir}/data/{os.path.basename(input_data)}.{rank:05d}")
+            download_shard(
+                input_data, filename, rank, n_hosts,
+                concurrency=args.download_concurrency)
+            data_file = open(filename, errors='ignore')
+            lines = data_file
+        else:
+            # the rows are parsed while the next blocks are downloaded
+            logger.info(
+                "Streaming data from %s, shard %d of %d",
+                input_data, rank + 1, n_hosts)
+            lines = (
+                line.decode("utf-8", errors="ignore")
+                for line in iter_shard_lines(
+                    input_data, rank, n_hosts,
+                    concurrency=args.download_concurrency))
 
-    sentences = []
-    y = [] # y-data
-    with open(filename, errors = 'ignore') as csv_file:
-        csv_reader = csv.reader(csv_file, delimiter='\t')
-        # skip first (header) row
-        next(csv_reader)
-        for row in csv_reader:
-            try:
-                sentences.append((row[3], row[4]))
-                y.append(float(row[0]))
-            except:
-                pass
-
-    logger.info("Reading data finished.")
-    os.unlink(filename)
-
-    '''
-    Feature Engineering
-    '''
-
-    _VALID_METRICS_ = ['euclidean', 'l2', 'l1', 'manhattan', 'cityblock',
-        'braycurtis', 'canberra', 'chebyshev', 'correlation',
-        'cosine', 'dice', 'hamming', 'jaccard', 'kulsinski',
-        'matching', 'minkowski', 'rogerstanimoto',
-        'russellrao', 'seuclidean', 'sokalmichener',
-        'sokalsneath', 'sqeuclidean', 'yule',]
-
-    distances_matrix = []
-    for s1, s2 in sentences:
-        # clean each pair of sentences
-        s1 = s1.translate(str.maketrans("", "", string.punctuation))
-        s2 = s2.translate(str.maketrans("", "", string.punctuation))
-
-        s1 = count_words(s1.split())
-        s2 = count_words(s2.split())
-
-        c = set(s1).union(set(s2))
-
-        s1 = CountVectorizer(s1, c)
-        s2 = CountVectorizer(s2, c)
-
-        s1 = np.array(s1,dtype=np.int32)
-        s2 = np.array(s2,dtype=np.int32)
-
-        s1 = s1.reshape(1,-1)
-        s2 = s2.reshape(1,-1)
-
-        # get all distances
-        vector = []
-        for distance in _VALID_METRICS_:
-            _, dist =  pairwise_distances_argmin_min(s1, s2, axis=1, metric=distance)
-            vector.append(dist[0])
-
-        distances_matrix.append(vector)
-
-    '''
-    Scaling
-    '''
-    _DISTANCE_MATRIX_NORM_ = []
-    for vector in distances_matrix:
-        _DISTANCE_MATRIX_NORM_.append(min_max_range(vector, (0.0,1.0)))
-    distances_matrix = np.array(_DISTANCE_MATRIX_NORM_)
-
-    '''
-    Clean null values if any
-    '''
-
-    distances_matrix[np.isnan(distances_matrix)] = np.nanmean(distances_matrix)
-    
-    '''
-    Split data
-    '''
-    
-    y = np.array(y).reshape(len(y), 1)
-    X = np.concatenate((y, distances_matrix), axis=1)
-    np.random.shuffle(X)
-    train, validation, test = np.split(X, [int(0.7 * len(X)), int(0.85 * len(X))])
-    
-    '''
-    Saving data
-    '''
-
-    logger.info("Saving transformed data.")
-    
-    s3_client = boto3.client('s3')
-
-    # train
-    filepath = f"{base_dir}/train/"
-    filename = f"train"
-    np.savetxt(filepath + filename + '.csv', train, delimiter=",")
-
-    # NOT NEEDED, sagamaker will do this for us
-    # logger.info("Uploading data to bucket: %s, key: %s", bucket, filename + '.csv')
-    # s3_client.upload_file(filepath + filename + '.csv', bucket, filename + '.csv')
-    
-    # validation
-    filepath = f"{base_dir}/validation/"
-    filename = f"validation"
-    np.savetxt(filepath + filename + '.csv', validation, delimiter=",")
-
-    # logger.info("Uploading data to bucket: %s, key: %s", bucket, filename + '.csv')
-    # s3_client.upload_file(filepath + filename + '.csv', bucket, filename + '.csv')
-    
-    # test
-    filepath = f"{base_dir}/test/"
-    filename = f"test"
-    np.savetxt(filepath + filename + '.csv', test, delimiter=",")
-
-    # logger.info("Uploading data to bucket: %s, key: %s", bucket, filename + '.csv')
-    # s3_client.upload_file(filepath + filename + '.csv', bucket, filename + '.csv')
-
-    logger.info("Data saved.")
+        '''
+        Feature Engineering
+
+        The dataset is read and featurized in chunks of rows that are
+        appended to a float32 matrix on disk (label in the first column), so
+        the memory used does not grow with the dataset size.
+        '''
+
+        metrics = _VALID_METRICS_
+        if args.metrics != "all":
+            metrics = [
+                m.strip() for m in args.metrics.split(",") if m.strip()]
+        # fail before any work on unknown metrics
+        plan_metrics(metrics)
+        logger.info(
+            "Computing %d metrics: %s", len(metrics), ", ".join(metrics))
+
+        shard_dir = f"{shards_dir}/part-{rank:05d}"
+        shard_files = open_shard(shard_dir)
+
+        logger.info("Reading and transforming data.")
+
+        # features of previous runs
+        store = None
+        if args.feature_store:
+            store = load_feature_store(
+                download_feature_store(args.feature_store, store_dir),
+                metrics)
+            logger.info(
+                "Feature store with %d pairs.",
+                0 if store is None else len(store[0]))
+
+        workers = args.workers if args.workers > 0 else (os.cpu_count() or 1)
+        executor = (
+            ProcessPoolExecutor(max_workers=workers) if workers > 1 else None)
+        n_rows, n_reused = 0, 0
+        for ids, sentences, y in read_chunks(
+                lines, args.chunk_size, header=header):
+            if n_rows == 0 and rank == 0 and args.profile_rows > 0:
+                # cost of each metric over a sample, as a processing output
+                sample = sentences[:args.profile_rows]
+                profile = {}
+                row_distances(
+                    *count_matrices(sample), metrics, profile=profile)
+                report = metrics_report(profile, metrics, len(sample))
+                report_dir = f"{base_dir}/report"
+                pathlib.Path(report_dir).mkdir(parents=True, exist_ok=True)
+                with open(f"{report_dir}/metrics_profile.json", "w") as f:
+                    json.dump(report, f, indent=2)
+
+            keys = pair_keys(ids)
+            digests = np.array(
+                [pair_digest(pair) for pair in sentences], dtype=np.uint64)
+            stored_rows = lookup_feature_store(store, keys, digests)
+            new_rows = np.flatnonzero(stored_rows < 0)
+
+            distances_matrix = np.empty(
+                (len(y), len(metrics)), dtype=np.float32)
+            if len(new_rows) < len(y):
+                reused = np.flatnonzero(stored_rows >= 0)
+                distances_matrix[reused] = store[3][stored_rows[reused]]
+                n_reused += len(reused)
+            if len(new_rows):
+                # scaled by the merge stage, see transform.scale_rows
+                distances_matrix[new_rows] = compute_distances(
+                    [sentences[i] for i in new_rows], metrics,
+                    workers=workers, executor=executor)
+
+            rows = np.empty((len(y), 1 + len(metrics)), dtype=np.float32)
+            rows[:, 0] = y
+            rows[:, 1:] = distances_matrix
+            shard_files["features"].write(rows.tobytes())
+            shard_files["key"].write(keys.tobytes())
+            shard_files["digest"].write(digests.tobytes())
+            # the splits of the merge stage, by the hash of the pair IDs
+            shard_files["assignment"].write(assign_splits(keys).tobytes())
+            n_rows += len(y)
+            logger.debug("Transformed %d rows.", n_rows)
+
+        if executor is not None:
+            executor.shutdown()
+        for shard_file in shard_files.values():
+            shard_file.close()
+        del store
+
+        logger.info(
+            "Reading data finished, %d rows, %d reused from the feature "
+            "store.", n_rows, n_reused)
+        if args.local_copy:
+            data_file.close()
+            os.unlink(filename)
+
+        # sagemaker uploads the shards folder of every host to the same S3
+        # uri, merged by the merge stage
+        save_shard(shard_dir, metrics, n_rows)
+
+    if args.stage in ("all", "merge"):
+        '''
+        Merge shards
+
+        The shards are concatenated in the order of the hosts ranks, the
+        splits do not depend on how many hosts computed the features.
+        '''
+
+        metrics, shards = load_shards(shards_dir)
+        n_rows = sum(len(rows) for _, _, rows, _ in shards)
+        logger.info("Merging %d shards, %d rows.", len(shards), n_rows)
+
+        if args.feature_store:
+            # sagemaker uploads the store folder to the same S3 uri
+            save_feature_store(
+                store_dir, metrics,
+                np.concatenate([keys for keys, _, _, _ in shards]),
+                np.concatenate([digests for _, digests, _, _ in shards]),
+                [rows[:, 1:] for _, _, rows, _ in shards])
+
+        '''
+        Scaling
+
+        Each row of distances is min-max scaled, by chunks of rows written to
+        a float32 matrix on disk (label in the first column).
+        '''
+
+        pathlib.Path(f"{base_dir}/data").mkdir(parents=True, exist_ok=True)
+        features_filename = f"{base_dir}/data/features.npy"
+        X = np.lib.format.open_memmap(
+            features_filename, mode="w+", dtype=np.float32,
+            shape=(n_rows, 1 + len(metrics)))
+        for start, block, _ in iter_shard_blocks(shards, args.chunk_size):
+            X[start:start + len(block), 0] = block[:, 0]
+            X[start:start + len(block), 1:] = scale_rows(block[:, 1:])
+
+        '''
+        Split data
+
+        Each row goes to a split by the hash of its pair IDs, the splits do
+        not change between runs and new pairs do not move the others. The
+        split indices are computed by the features stage and read from the
+        shards chunk by chunk.
+        '''
+
+        sizes = split_sizes(shards, args.chunk_size)
+
+        '''
+        Clean null values if any
+
+        The missing values are imputed with the mean of the train split
+        features, the statistics are saved with the train split for the
+        serving, see transform.py.
+        '''
+
+        train_split = _SPLITS_.index("train")
+        statistics = fit_imputation(
+            X[start:start + len(assignment), 1:][assignment == train_split]
+            for start, _, assignment in iter_shard_blocks(
+                shards, args.chunk_size))
+        logger.info("Imputation statistics: %s", statistics)
+
+        '''
+        Saving data
+        '''
+
+        logger.info("Saving transformed data.")
+
+        # written by chunks of rows in a single pass, sagemaker will upload
+        # each output folder for us
+        split_files, written = [], []
+        for split, name in enumerate(_SPLITS_):
+            pathlib.Path(f"{base_dir}/{name}").mkdir(
+                parents=True, exist_ok=True)
+            # features schema, the columns of the split after the label
+            with open(f"{base_dir}/{name}/features.json", "w") as f:
+                json.dump({"label": "label", "features": metrics}, f)
+
+            filename = f"{base_dir}/{name}/{name}.{args.split_format}"
+            if args.split_format == "npy":
+                split_files.append(np.lib.format.open_memmap(
+                    filename, mode="w+", dtype=np.float32,
+                    shape=(int(sizes[split]), X.shape[1])))
+            else:
+                split_files.append(open(filename, "w"))
+            written.append(0)
+
+        for start, _, assignment in iter_shard_blocks(
+                shards, args.chunk_size):
+            block = np.array(X[start:start + len(assignment)])
+            impute(block[:, 1:], statistics)
+            for split, split_file in enumerate(split_files):
+                rows = block[assignment == split]
+                if args.split_format == "npy":
+                    split_file[written[split]:written[split] + len(rows)] = (
+                        rows)
+                else:
+                    np.savetxt(
+                        split_file, rows, delimiter=",", fmt="%.7g")
+                written[split] += len(rows)
+
+        for split_file in split_files:
+            if args.split_format == "npy":
+                split_file.flush()
+            else:
+                split_file.close()
+        logger.info(
+            "Split sizes: %s", ", ".join(
+                f"{name} {count}" for name, count in zip(_SPLITS_, written)))
+        del split_files
+
+        save_statistics(f"{base_dir}/train/transform.json", statistics)
+
+        del X, shards
+        os.unlink(features_filename)
+        if args.stage == "all":
+            # the shard of this host only, not a processing output
+            shutil.rmtree(shards_dir)
+
+        logger.info("Data saved.")
 
     logger.info("End preprocessing.")
@@ -0,0 +1,166 @@
+"""Read the train, validation and test splits written by preprocess.
+
+Each split folder holds the split rows, the label in the first column and the
+features after it, and a features.json with the columns names. The rows are
+either a float32 .npy matrix, loaded without parsing, or a headerless text
+csv, see preprocess --split-format.
+
+This module is used by the training, evaluation and baseline scripts, the
+processing steps receive it as an input, and by utils.load_dataset.
+"""
+import os
+import json
+from itertools import islice
+
+import numpy as np
+
+SPLIT_FORMATS = ("npy", "csv")
+
+
+def split_filename(path, name):
+    """Returns the file of a split and its format.
+
+    Args:
+        path: the split folder
+        name: the split name, e.g. train
+
+    Returns:
+        a tuple (filename, format), the .npy file is preferred when both
+        formats exist
+    """
+    for split_format in SPLIT_FORMATS:
+        filename = os.path.join(path, f"{name}.{split_format}")
+        if os.path.exists(filename):
+            return filename, split_format
+    raise FileNotFoundError(f"No {name} split found in {path}")
+
+
+def read_columns(path, n_features):
+    """Returns the label and features names of a split folder.
+
+    Args:
+        path: the split folder
+        n_features: the number of features, used to name the columns when
+            the folder has no features.json
+
+    Returns:
+        a tuple (label, features)
+    """
+    features_path = os.path.join(path, "features.json")
+    if not os.path.exists(features_path):
+        return "label", [f"feature_{i}" for i in range(n_features)]
+    with open(features_path) as f:
+        columns = json.load(f)
+    return columns["label"], columns["features"]
+
+
+def _read_npy_rows(filename, dtype, chunk_size):
+    """Reads a .npy split in separate features and labels arrays of dtype.
+
+    The file is read by chunks of rows, the float32 rows are never held in
+    memory all at once, only the converted arrays are.
+    """
+    with open(filename, "rb") as f:
+        if np.lib.format.read_magic(f) == (1, 0):
+            read_header = np.lib.format.read_array_header_1_0
+        else:
+            read_header = np.lib.format.read_array_header_2_0
+        shape, fortran_order, file_dtype = read_header(f)
+        if fortran_order:
+            raise ValueError(f"{filename} is not in C order")
+        n_rows, n_columns = shape
+        X = np.empty((n_rows, n_columns - 1), dtype=dtype)
+        y = np.empty(n_rows, dtype=dtype)
+        for start in range(0, n_rows, chunk_size):
+            count = min(chunk_size, n_rows - start)
+            rows = np.fromfile(
+                f, dtype=file_dtype, count=count * n_columns).reshape(
+                    count, n_columns)
+            X[start:start + count] = rows[:, 1:]
+            y[start:start + count] = rows[:, 0]
+    return X, y
+
+
+def read_split(path, name, mmap_mode=None, dtype=None, chunk_size=65536):
+    """Reads a split.
+
+    Without dtype the features and labels are views of the rows read, no copy
+    is made. With mmap_mode a .npy split is memory mapped, the pages are read
+    from disk when used and can be evicted, so the split does not count
+    against the process memory.
+
+    With dtype the features are a C ordered matrix of that dtype, read by
+    chunks of rows, for estimators that would otherwise make their own copy,
+    e.g. LogisticRegression fit with the lbfgs solver needs float64.
+
+    Args:
+        path: the split folder
+        name: the split name, e.g. train
+        mmap_mode: the np.load mmap_mode of a .npy split, e.g. "r"
+        dtype: the features and labels dtype, None to keep the file one
+        chunk_size: the rows read at once when converting to dtype
+
+    Returns:
+        a tuple (X, y, features) with the features matrix, the labels and
+        the features names
+    """
+    filename, split_format = split_filename(path, name)
+    if split_format == "npy" and dtype is not None:
+        X, y = _read_npy_rows(filename, dtype, chunk_size)
+        _, features = read_columns(path, X.shape[1])
+        return X, y, features
+    if split_format == "npy":
+        rows = np.load(filename, mmap_mode=mmap_mode)
+    else:
+        rows = np.loadtxt(
+            filename, delimiter=",", dtype=np.float32, ndmin=2)
+    _, features = read_columns(path, rows.shape[1] - 1)
+    X, y = rows[:, 1:], rows[:, 0]
+    if dtype is not None:
+        X = np.ascontiguousarray(X, dtype=dtype)
+        y = y.astype(dtype)
+    return X, y, features
+
+
+def iter_split(path, name, chunk_size=65536, dtype=None, start_chunk=0):
+    """Reads a split by chunks of rows, never holding it all in memory.
+
+    A .npy split is memory mapped and sliced, a csv split is parsed a chunk
+    of lines at a time.
+
+    Args:
+        path: the split folder
+        name: the split name, e.g. train
+        chunk_size: the rows of each chunk
+        dtype: the features and labels dtype, None to keep the file one
+        start_chunk: the index of the first chunk, the previous rows are
+            skipped without being parsed
+
+    Yields:
+        tuples (X, y) of the features and labels of each chunk
+    """
+    filename, split_format = split_filename(path, name)
+    if split_format == "npy":
+        rows = np.load(filename, mmap_mode="r")
+        chunks = (
+            rows[start:start + chunk_size]
+            for start in range(
+                start_chunk * chunk_size, len(rows), chunk_size))
+    else:
+        def read_csv_chunks():
+            with open(filename) as f:
+                for _ in islice(f, start_chunk * chunk_size):
+                    pass
+                while True:
+                    lines = list(islice(f, chunk_size))
+                    if not lines:
+                        return
+                    yield np.loadtxt(
+                        lines, delimiter=",", dtype=np.float32, ndmin=2)
+        chunks = read_csv_chunks()
+    for chunk in chunks:
+        X, y = chunk[:, 1:], chunk[:, 0]
+        if dtype is not None:
+            X = np.ascontiguousarray(X, dtype=dtype)
+            y = y.astype(dtype)
+        yield X, y
@@ -1,54 +1,559 @@
 """Load and prepare sts dataset."""
 
 import os
+import json
+import hashlib
 import pickle
 import pathlib
+import shutil
 import boto3
 import logging
 import argparse
+import re
+import time
 import warnings
 import numpy as np
 import sklearn
-import pandas as pd
 from subprocess import run
 
-from sklearn.model_selection import StratifiedShuffleSplit
-from sklearn.linear_model import LogisticRegression
+from sklearn.model_selection import (
+    GridSearchCV, StratifiedKFold, StratifiedShuffleSplit)
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.linear_model import LogisticRegression, SGDClassifier
+from sklearn.neighbors import KNeighborsClassifier
 import joblib
 
+from compact_model import export_model
+from inference import load_model, single_row_latencies
+from splits import iter_split, read_columns, read_split
+
 warnings.filterwarnings(action='ignore')
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 logger.addHandler(logging.StreamHandler())
 
+# the logistic loss of the SGDClassifier, renamed "log_loss" by sklearn 1.1
+# and "log" removed by sklearn 1.3
+SGD_LOG_LOSS = (
+    "log_loss"
+    if tuple(map(int, re.findall(r"\d+", sklearn.__version__)[:2])) >= (1, 1)
+    else "log")
+
+# the LogisticRegression hyperparameters of the search mode, lbfgs only
+# supports the l2 penalty
+SEARCH_GRID = [
+    {"solver": ["lbfgs"], "penalty": ["l2"], "C": [0.01, 0.1, 1.0, 10.0]},
+    {"solver": ["liblinear", "saga"], "penalty": ["l1", "l2"],
+     "C": [0.01, 0.1, 1.0, 10.0]},
+]
+
+# the estimators of the tournament mode, by name
+TOURNAMENT_CANDIDATES = {
+    "linear": lambda: LogisticRegression(max_iter=200, multi_class='ovr'),
+    "forest": lambda: RandomForestClassifier(
+        n_estimators=100, min_samples_leaf=5, random_state=0),
+    "knn": lambda: KNeighborsClassifier(n_neighbors=15),
+}
+
+
+def fit_candidate(X, y, params):
+    """Fits a LogisticRegression with the given hyperparameters."""
+    return LogisticRegression(
+        max_iter=200, multi_class='ovr', **params).fit(X, y)
+
+
+def search_model(X, y, X_val=None, y_val=None, cv_folds=3, top_k=3,
+                 n_jobs=1):
+    """Searches the solver, C and penalty of a LogisticRegression.
+
+    The candidates of SEARCH_GRID are cross validated on the train split,
+    every (candidate, fold) fit is a task of a process pool. The top_k
+    candidates by mean accuracy are then fit on the whole train split and the
+    most accurate on the validation split is selected.
+
+    Args:
+        X: the train features
+        y: the train labels
+        X_val: the validation features, None to select by cross validation
+        y_val: the validation labels
+        cv_folds: the cross validation folds
+        top_k: the candidates scored on the validation split
+        n_jobs: the processes of the pool
+
+    Returns:
+        a tuple (model, results) with the selected model, fit on the train
+        split, and the search results of every candidate
+    """
+    search = GridSearchCV(
+        LogisticRegression(max_iter=200, multi_class='ovr'), SEARCH_GRID,
+        scoring="accuracy", refit=False, n_jobs=n_jobs,
+        cv=StratifiedKFold(cv_folds, shuffle=True, random_state=0))
+    search.fit(X, y)
+    cv = search.cv_results_
+    results = sorted([
+        {
+            "params": cv["params"][i],
+            "cv_accuracy": float(cv["mean_test_score"][i]),
+            "cv_accuracy_std": float(cv["std_test_score"][i]),
+            "fit_time": float(cv["mean_fit_time"][i]),
+        }
+        for i in range(len(cv["params"]))
+    ], key=lambda result: -result["cv_accuracy"])
+
+    top = results[:top_k] if X_val is not None else results[:1]
+    models = joblib.Parallel(n_jobs=min(n_jobs, len(top)))(
+        joblib.delayed(fit_candidate)(X, y, result["params"])
+        for result in top)
+    if X_val is None:
+        return models[0], results
+    for result, model in zip(top, models):
+        result["validation_accuracy"] = float(
+            np.mean(model.predict(X_val) == y_val))
+    # the first best on the validation split, the best cross validated on ties
+    best = max(
+        range(len(top)), key=lambda i: (top[i]["validation_accuracy"], -i))
+    return models[best], results
+
+
+def fit_estimator(name, X, y):
+    """Fits a tournament candidate, returns it with its fit time."""
+    start = time.perf_counter()
+    model = TOURNAMENT_CANDIDATES[name]().fit(X, y)
+    return model, time.perf_counter() - start
+
+
+def run_tournament(X, y, X_val, y_val, names, latency_budget, n_jobs=1):
+    """Trains several estimators on the same data and selects the best one.
+
+    The candidates are fit at the same time on a process pool, the train
+    split is shared with the processes through a memory map rather than
+    copied. Each one is then scored on the validation split, for its
+    accuracy and its single row predict latency, one after the other so that
+    the latencies are measured on an idle CPU.
+
+    Args:
+        X: the train features
+        y: the train labels
+        X_val: the validation features
+        y_val: the validation labels
+        names: the TOURNAMENT_CANDIDATES names
+        latency_budget: the maximum p99 predict latency, in milliseconds, of
+            the winner
+        n_jobs: the processes of the pool
+
+    Returns:
+        a tuple (model, results) with the winner, the most accurate candidate
+        within the latency budget, the fastest on ties, and the results of
+        every candidate
+    """
+    fitted = joblib.Parallel(n_jobs=min(n_jobs, len(names)))(
+        joblib.delayed(fit_estimator)(name, X, y) for name in names)
+    results = []
+    for name, (model, fit_time) in zip(names, fitted):
+        latencies = single_row_latencies(model, X_val)
+        results.append({
+            "name": name,
+            "estimator": type(model).__name__,
+            "fit_time": fit_time,
+            "validation_accuracy": float(np.mean(model.predict(X_val) == y_val)),
+            "predict_p50_ms": float(np.percentile(latencies, 50)),
+            "predict_p99_ms": float(np.percentile(latencies, 99)),
+        })
+        logger.info("Candidate %s: %s", name, results[-1])
+
+    eligible = [
+        i for i, result in enumerate(results)
+        if result["predict_p99_ms"] <= latency_budget]
+    if not eligible:
+        logger.warning(
+            "No candidate within the %f ms latency budget.", latency_budget)
+        eligible = list(range(len(results)))
+    winner = max(eligible, key=lambda i: (
+        results[i]["validation_accuracy"], -results[i]["predict_p99_ms"]))
+    results[winner]["winner"] = True
+    return fitted[winner][0], results
+
+
+def split_statistics(train_path, chunk_size):
+    """Reads the train split once, by chunks, for its labels and spread.
+
+    Returns:
+        a tuple (rows, classes, std) with the number of rows, the labels and
+        the standard deviation of each feature column
+    """
+    rows, classes = 0, set()
+    total = squares = 0.0
+    for X, y in iter_split(train_path, "train", chunk_size, np.float64):
+        rows += len(y)
+        classes.update(np.unique(y.astype(np.int64)).tolist())
+        total = total + X.sum(axis=0)
+        squares = squares + np.square(X).sum(axis=0)
+    mean = total / rows
+    std = np.sqrt(np.maximum(squares / rows - np.square(mean), 0.0))
+    return rows, np.array(sorted(classes)), std
+
+
+def training_fingerprint(train_path, settings, previous_model=None):
+    """Identifies a training run by its data and settings.
+
+    A checkpoint is only resumed by the run that wrote it: the checkpoint
+    location is the same for every execution of the pipeline, a run on other
+    data or with other hyperparameters starts over.
+
+    Args:
+        train_path: the train split folder, the whole content of its files
+            is hashed, a single changed row changes the fingerprint
+        settings: dict of the hyperparameters of the run
+        previous_model: the model.tar.gz the run starts from, if any
+
+    Returns:
+        the hex digest
+    """
+    digest = hashlib.sha256(
+        json.dumps(settings, sort_keys=True).encode("utf-8"))
+    paths = [
+        os.path.join(train_path, name) for name in sorted(os.listdir(train_path))]
+    if previous_model and os.path.isdir(previous_model):
+        previous_model = os.path.join(previous_model, "model.tar.gz")
+    if previous_model and os.path.exists(previous_model):
+        paths.append(previous_model)
+    for path in paths:
+        if not os.path.isfile(path):
+            continue
+        size = os.path.getsize(path)
+        digest.update(f"{os.path.basename(path)}:{size}".encode("utf-8"))
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def load_checkpoint(checkpoint_dir, fingerprint, name="incremental.joblib"):
+    """Loads the checkpoint of an interrupted run.
+
+    Args:
+        checkpoint_dir: the checkpoints folder, restored from S3 by SageMaker
+            when the job starts again
+        fingerprint: the run fingerprint, see `training_fingerprint`
+        name: the file name of the checkpoint
+
+    Returns:
+        the checkpoint state, None if there is none or if it is of another run
+    """
+    path = os.path.join(checkpoint_dir, name)
+    if not os.path.exists(path):
+        return None
+    try:
+        state = joblib.load(path)
+    except Exception as e:
+        logger.warning("Ignoring unreadable checkpoint %s: %s", path, e)
+        return None
+    if state.get("fingerprint") != fingerprint:
+        logger.info("The checkpoint is of another run, starting over.")
+        return None
+    return state
+
+
+def save_checkpoint(checkpoint_dir, state, name="incremental.joblib"):
+    """Saves a checkpoint, replacing the previous one atomically.
+
+    The checkpoint is written next to the previous one and renamed over it,
+    an interruption while saving leaves the previous checkpoint intact.
+    """
+    pathlib.Path(checkpoint_dir).mkdir(parents=True, exist_ok=True)
+    path = os.path.join(checkpoint_dir, name)
+    joblib.dump(state, path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+
+def clear_checkpoint(checkpoint_dir, name="incremental.joblib"):
+    """Clears the checkpoint of a run that succeeded.
+
+    The checkpoint is replaced by one of no run rather than removed:
+    SageMaker uploads the changed files of the checkpoints folder to S3, a
+    removed file could be restored by the next job, which would return the
+    model of this run.
+    """
+    if os.path.exists(os.path.join(checkpoint_dir, name)):
+        save_checkpoint(checkpoint_dir, {"fingerprint": None}, name)
+
+
+def fit_incremental(train_path, epochs, chunk_size, alpha, warm_start=None,
+                    checkpoint_dir=None, checkpoint_every=10,
+                    fingerprint=None):
+    """Fits a logistic regression with SGD, a chunk of rows at a time.
+
+    The split is never held in memory, only a chunk of rows, each epoch
+    reads it again from the memory mapped .npy, or the csv, file.
+
+    With a checkpoint folder, the model, the position in the split and the
+    shuffling random state are saved every checkpoint_every chunks and at the
+    end of each epoch. A run started again, e.g. after a spot interruption,
+    resumes from the last checkpoint and fits the same model as an
+    uninterrupted run.
+
+    Args:
+        train_path: the train split folder
+        epochs: the passes over the train split
+        chunk_size: the rows of each partial_fit
+        alpha: the regularization strength of the SGDClassifier
+        warm_start: a previous linear model to start from, e.g. the last
+            registered one, ignored if its features differ
+        checkpoint_dir: the checkpoints folder, None to not checkpoint
+        checkpoint_every: the chunks between two checkpoints
+        fingerprint: the run fingerprint, see `training_fingerprint`, a
+            checkpoint of another fingerprint is ignored
+
+    Returns:
+        a tuple (model, std) with the fitted model and the standard deviation
+        of the features
+    """
+    state = None
+    if checkpoint_dir:
+        state = load_checkpoint(checkpoint_dir, fingerprint)
+    if state is not None:
+        logger.info(
+            "Resuming from the checkpoint after %d epochs and %d chunks.",
+            state["epoch"], state["chunk"])
+    else:
+        rows, classes, std = split_statistics(train_path, chunk_size)
+        model = SGDClassifier(loss=SGD_LOG_LOSS, alpha=alpha, random_state=0)
+        if warm_start is not None and getattr(
+                warm_start, "coef_", np.empty((0, 0))).shape == (1, len(std)):
+            logger.info("Warm starting from the previous model coefficients.")
+            model.coef_ = np.array(warm_start.coef_, dtype=np.float64)
+            model.intercept_ = np.array(
+                warm_start.intercept_, dtype=np.float64)
+            # the learning rate decays with the updates count, starting as
+            # after an epoch keeps the first steps from undoing the previous
+            # model
+            model.t_ = float(rows)
+        elif warm_start is not None:
+            logger.info("The previous model has other features, cold start.")
+        state = {
+            "fingerprint": fingerprint,
+            "classes": classes,
+            "std": std,
+            "model": model,
+            "random_state": np.random.RandomState(0),
+            "epoch": 0,
+            "chunk": 0,
+        }
+
+    model, classes = state["model"], state["classes"]
+    random_state = state["random_state"]
+    for epoch in range(state["epoch"], epochs):
+        start_chunk = state["chunk"] if epoch == state["epoch"] else 0
+        chunks = iter_split(
+            train_path, "train", chunk_size, np.float64, start_chunk)
+        for index, (X, y) in enumerate(chunks, start_chunk):
+            order = random_state.permutation(len(y))
+            model.partial_fit(
+                X[order], y[order].astype(np.int64), classes=classes)
+            if checkpoint_dir and (index + 1) % checkpoint_every == 0:
+                save_checkpoint(
+                    checkpoint_dir, dict(state, epoch=epoch, chunk=index + 1))
+        logger.info("Epoch %d done.", epoch + 1)
+        if checkpoint_dir:
+            save_checkpoint(
+                checkpoint_dir, dict(state, epoch=epoch + 1, chunk=0))
+    return model, state["std"]
+
+
 # main routine
 if __name__ == "__main__":
     logger.debug("Starting modeling.")
     base_dir = "/opt/ml/processing"
     bucket = "sts-demo-datasets"
 
+    # hyperparameters of the estimator are given as arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--solver", type=str, default="lbfgs",
+        help="LogisticRegression solver, newton-cg, sag and saga train on "
+             "the float32 features, lbfgs and liblinear need float64")
+    parser.add_argument(
+        "--mode", type=str,
+        default=os.environ.get("STS_TRAINING_MODE", "batch"),
+        choices=["batch", "incremental", "search", "tournament"],
+        help="batch fits a LogisticRegression on the split in memory, "
+             "incremental fits a SGD logistic regression by chunks of rows "
+             "with partial_fit, warm started from the model channel, search "
+             "selects the LogisticRegression solver, C and penalty, "
+             "tournament selects the best of several estimators")
+    parser.add_argument(
+        "--epochs", type=int, default=5,
+        help="passes over the train split of the incremental mode")
+    parser.add_argument(
+        "--chunk-size", type=int, default=65536,
+        help="rows of each partial_fit of the incremental mode")
+    parser.add_argument(
+        "--alpha", type=float, default=0.0001,
+        help="regularization strength of the incremental mode")
+    parser.add_argument(
+        "--checkpoint-dir", type=str, default="/opt/ml/checkpoints",
+        help="folder of the incremental mode checkpoints, synced with S3 by "
+             "SageMaker, the mode does not checkpoint if it does not exist")
+    parser.add_argument(
+        "--checkpoint-every", type=int, default=10,
+        help="chunks between two checkpoints of the incremental mode")
+    parser.add_argument(
+        "--cv-folds", type=int, default=3,
+        help="cross validation folds of the search mode")
+    parser.add_argument(
+        "--top-k", type=int, default=3,
+        help="best cross validated candidates of the search mode scored on "
+             "the validation split")
+    parser.add_argument(
+        "--search-jobs", type=int, default=0,
+        help="processes of the search and tournament modes, 0 uses all "
+             "the CPUs")
+    parser.add_argument(
+        "--candidates", type=str, default="linear,forest,knn",
+        help="comma separated estimators of the tournament mode, among "
+             + ", ".join(TOURNAMENT_CANDIDATES))
+    parser.add_argument(
+        "--latency-budget", type=float,
+        default=float(os.environ.get("STS_LATENCY_BUDGET_MS", 100.0)),
+        help="maximum p99 single row predict latency, in milliseconds, of "
+             "the tournament winner, the budget of the registration by "
+             "default")
+    args, _ = parser.parse_known_args()
+
     logger.debug("Reading train data.")
     train_path = os.environ.get('SM_CHANNEL_TRAIN')
     logger.info(run("ls "+train_path, shell=True))
-    df = pd.read_csv(train_path + "/train.csv", header=None)
 
+    checkpoint_dir = None
+
+    if args.mode == "incremental":
+        logger.info("Starting incremental model creation.")
+        # the last registered model, given by the pipeline when there is one
+        previous_path = os.environ.get('SM_CHANNEL_MODEL')
+        previous = None
+        if previous_path:
+            try:
+                previous = load_model(previous_path)
+            except FileNotFoundError:
+                logger.info("No previous model in %s.", previous_path)
+        # the folder is there when the estimator has a checkpoint uri, e.g.
+        # on spot instances, an interrupted job resumes from its content
+        checkpoint_dir = (
+            args.checkpoint_dir if os.path.isdir(args.checkpoint_dir)
+            else None)
+        fingerprint = None
+        if checkpoint_dir:
+            fingerprint = training_fingerprint(
+                train_path, {
+                    "epochs": args.epochs,
+                    "chunk_size": args.chunk_size,
+                    "alpha": args.alpha,
+                }, previous_path)
+        logreg, std = fit_incremental(
+            train_path, args.epochs, args.chunk_size, args.alpha,
+            warm_start=previous, checkpoint_dir=checkpoint_dir,
+            checkpoint_every=args.checkpoint_every, fingerprint=fingerprint)
+        _, feature_names = read_columns(train_path, len(std))
+    else:
+        # the solver works on a C ordered matrix of its dtype, read by chunks
+        # so that it is the only copy of the split in memory
+        dtype = (
+            np.float64 if args.solver in ("lbfgs", "liblinear")
+            or args.mode in ("search", "tournament") else np.float32)
+        X_train, Y_train, feature_names = read_split(
+            train_path, "train", dtype=dtype)
+        Y_train = Y_train.astype(np.int64)
 
-    # Extracting data from pandas DataFrame
-    Y_train = df.iloc[:, 0].to_numpy()
-    df.drop(df.columns[0], axis=1, inplace=True)
-    X_train = df.values
+        logger.info("Starting model creation.")
+        '''
+        Classification
+        multi_class = 'ovr' is set for this problem where there are only two binary classes.
+        '''
+        validation_path = os.environ.get('SM_CHANNEL_VALIDATION')
+        X_val = y_val = None
+        if validation_path and args.mode in ("search", "tournament"):
+            X_val, y_val, _ = read_split(
+                validation_path, "validation", mmap_mode="r")
+            y_val = y_val.astype(np.int64)
+        n_jobs = (
+            args.search_jobs if args.search_jobs > 0
+            else (os.cpu_count() or 1))
+        output_dir = os.environ.get(
+            'SM_OUTPUT_DATA_DIR', '/opt/ml/output/data')
+        if args.mode == "tournament":
+            logreg, results = run_tournament(
+                X_train, Y_train, X_val, y_val,
+                [name for name in args.candidates.split(",") if name],
+                args.latency_budget, n_jobs=n_jobs)
+            logger.info("Tournament winner: %s", type(logreg).__name__)
+            pathlib.Path(output_dir).mkdir(parents=True, exist_ok=True)
+            with open(os.path.join(
+                    output_dir, "tournament_results.json"), "w") as f:
+                json.dump({
+                    "latency_budget_ms": args.latency_budget,
+                    "candidates": results,
+                }, f, indent=2)
+        elif args.mode == "search":
+            logreg, results = search_model(
+                X_train, Y_train, X_val, y_val, cv_folds=args.cv_folds,
+                top_k=args.top_k, n_jobs=n_jobs)
+            logger.info("Selected hyperparameters: %s", logreg.get_params())
+            pathlib.Path(output_dir).mkdir(parents=True, exist_ok=True)
+            with open(
+                    os.path.join(output_dir, "search_results.json"), "w") as f:
+                json.dump({
+                    "scoring": "accuracy",
+                    "cv_folds": args.cv_folds,
+                    "best": {
+                        name: logreg.get_params()[name]
+                        for name in ("solver", "penalty", "C")},
+                    "candidates": results,
+                }, f, indent=2)
+        else:
+            # instantiate the model (using the default parameters)
+            logreg = LogisticRegression(
+                max_iter=200, n_jobs=4, multi_class='ovr',
+                solver=args.solver)
 
-    logger.info("Starting model creation.")
-    '''
-    Classification
-    multi_class = 'ovr' is set for this problem where there are only two binary classes.
-    '''
-    # instantiate the model (using the default parameters)
-    logreg = LogisticRegression(max_iter=200, n_jobs=4, multi_class='ovr')
+            # fit the model with data
+            logreg.fit(X_train, Y_train)
+        # one column at a time, X_train.std(axis=0) would copy X_train
+        std = np.array(
+            [X_train[:, i].std() for i in range(X_train.shape[1])])
 
-    # fit the model with data
-    logreg.fit(X_train, Y_train)
+    logger.info("Saving features weights report.")
+    if hasattr(logreg, "coef_"):
+        # the coefficient scaled by the feature spread is comparable between
+        # features, a feature with importance close to 0 can be dropped
+        coefficients = logreg.coef_[0].tolist()
+        importances = np.abs(logreg.coef_[0]) * std
+        intercept = float(logreg.intercept_[0])
+    else:
+        # a tournament winner without coefficients, e.g. the tree ensemble
+        # impurity importances, or none for the k-NN
+        coefficients = [None] * len(feature_names)
+        importances = getattr(
+            logreg, "feature_importances_", np.zeros(len(feature_names)))
+        intercept = None
+    weights = sorted(
+        zip(feature_names, coefficients, importances.tolist()),
+        key=lambda weight: -weight[2])
+    report = {
+        "intercept": intercept,
+        "features": [
+            {"name": name, "coefficient": coefficient, "importance": importance}
+            for name, coefficient, importance in weights
+        ],
+    }
+    output_dir = os.environ.get('SM_OUTPUT_DATA_DIR', '/opt/ml/output/data')
+    pathlib.Path(output_dir).mkdir(parents=True, exist_ok=True)
+    with open(os.path.join(output_dir, "feature_weights.json"), "w") as f:
+        json.dump(report, f, indent=2)
+    for name, coefficient, importance in weights:
+        logger.info(
+            "Feature %s coefficient: %s importance: %f",
+            name, coefficient, importance)
 
     logger.info("Saving trained model.")
 
@@ -56,4 +561,30 @@ if __name__ == "__main__":
     filename = os.path.join(os.environ.get('SM_MODEL_DIR'), "model.joblib")
     joblib.dump(logreg, filename)
 
+    # the linear models are also exported as model.npz, served with NumPy
+    # only by model_loader.py, see compact_model.py
+    model_dir = os.environ.get('SM_MODEL_DIR')
+    if export_model(
+            logreg, os.path.join(model_dir, "model.npz"), feature_names):
+        shutil.copy(
+            os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         "compact_model.py"),
+            model_dir)
+    else:
+        logger.info("The model is not linear, no compact artifact.")
+
+    # the features transform applied again at serving time, see
+    # model_loader.py, with the imputation statistics of the train split
+    statistics_path = os.path.join(train_path, "transform.json")
+    if os.path.exists(statistics_path):
+        shutil.copy(statistics_path, model_dir)
+        shutil.copy(
+            os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         "transform.py"),
+            model_dir)
+
+    if checkpoint_dir:
+        # the model is saved, a later run starts over instead of resuming
+        clear_checkpoint(checkpoint_dir)
+
     logger.info("End modeling.")
@@ -0,0 +1,101 @@
+"""Scale and impute the features of the sts pairs.
+
+The distances computed by preprocess are min-max scaled row by row, then the
+missing values are imputed with the mean of the scaled features of the
+training data. The imputation statistics are recorded by preprocess in
+transform.json next to the train split, copied with this module in the model
+artifact by training.py and applied again by model_loader.py at serving time.
+
+The transform of a transformed row is the row itself, so the rows of the
+splits can be sent to the endpoint as they are.
+"""
+import json
+
+import numpy as np
+
+# scaled features range and decimals, as the former preprocess.min_max_range
+FEATURE_RANGE = (0.0, 1.0)
+DECIMALS = 5
+
+
+def scale_rows(X, feature_range=FEATURE_RANGE, decimals=DECIMALS):
+    """Min-max scales each row of a matrix to feature_range.
+
+    The missing (NaN) values are ignored and kept. The rows without a range,
+    all the values equal or missing, can not be scaled and all their values
+    become missing.
+
+    Args:
+        X: the matrix, a row per pair and a column per distance
+        feature_range: the (min, max) of the scaled values
+        decimals: the decimals the scaled values are rounded to
+
+    Returns:
+        the scaled float64 matrix
+    """
+    X = np.asarray(X, dtype=np.float64)
+    if X.size == 0:
+        return X.copy()
+    # fmin and fmax ignore NaN without warnings on the all NaN rows
+    low = np.fmin.reduce(X, axis=1, keepdims=True)
+    span = np.fmax.reduce(X, axis=1, keepdims=True) - low
+    span[span == 0] = np.nan
+    scaled = (X - low) / span
+    scaled *= feature_range[1] - feature_range[0]
+    scaled += feature_range[0]
+    return np.round(scaled, decimals, out=scaled)
+
+
+def fit_imputation(blocks, decimals=DECIMALS):
+    """Computes the imputation statistics of scaled features.
+
+    Args:
+        blocks: iterable of scaled features matrices, e.g. the chunks of rows
+            of the training data
+        decimals: the decimals the imputed value is rounded to, as the
+            scaled values so that imputing twice changes nothing
+
+    Returns:
+        the statistics dict, see `impute`
+    """
+    total, count, missing = 0.0, 0, 0
+    for block in blocks:
+        block = np.asarray(block)
+        block_count = int(np.count_nonzero(~np.isnan(block)))
+        total += np.nansum(block, dtype=np.float64)
+        count += block_count
+        missing += block.size - block_count
+    mean = round(total / count, decimals) if count else None
+    return {"fill_value": mean, "count": count, "missing": missing}
+
+
+def impute(X, statistics):
+    """Replaces in place the missing values of X by the statistics one."""
+    fill_value = statistics["fill_value"]
+    X[np.isnan(X)] = np.nan if fill_value is None else fill_value
+    return X
+
+
+def transform(X, statistics):
+    """Scales and imputes the rows of X.
+
+    Args:
+        X: the matrix of the distances of some pairs
+        statistics: the imputation statistics, see `fit_imputation`
+
+    Returns:
+        the float32 features
+    """
+    return impute(scale_rows(X), statistics).astype(np.float32)
+
+
+def save_statistics(path, statistics):
+    """Writes the imputation statistics to a json file."""
+    with open(path, "w") as f:
+        json.dump(statistics, f)
+
+
+def load_statistics(path):
+    """Reads the imputation statistics written by `save_statistics`."""
+    with open(path) as f:
+        return json.load(f)
@@ -3,20 +3,25 @@ import sagemaker
 import boto3
 import sagemaker.session
 import tempfile
+import numpy as np
 import pandas as pd
 import os
 
+from sts.splits import read_split
+
 
 def load_dataset(
-    s3_uri: str, filename: str, sagemaker_session=None
+    s3_uri: str, name: str, sagemaker_session=None
 ) -> pd.DataFrame:
-    """Load a data set from a S3 uri"""
+    """Load a data set split from a S3 uri, the label is the first column"""
+    path = tempfile.mkdtemp()
     S3Downloader.download(
-        s3_uri, tempfile.gettempdir(),
+        s3_uri, path,
         sagemaker_session=sagemaker_session)
-    dataset_filename = os.path.join(
-        tempfile.gettempdir(), filename)
-    return pd.read_csv(dataset_filename, header=None)
+    # the split name, e.g. train, the format is detected by read_split
+    name = os.path.splitext(name)[0]
+    X, y, features = read_split(path, name)
+    return pd.DataFrame(np.column_stack([y, X]), columns=["label"] + features)
 
 
 def get_sm_session(
@@ -41,7 +41,7 @@ def main(deploy_data, train_data):
 
     # read test data
     test_data = load_dataset(
-        train_data['train']['test'], 'test.csv', sagemaker_session=sm_session)
+        train_data['train']['test'], 'test', sagemaker_session=sm_session)
     print(f"Loadding {train_data['train']['test']}")
 
     # remove labels in the test dataset
@@ -0,0 +1,7 @@
+"""The scripts of sts/ import their sibling modules directly, as they do in
+the SageMaker containers, so sts/ is put on the path of the tests."""
+import os
+import sys
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "sts"))
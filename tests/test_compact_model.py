@@ -0,0 +1,125 @@
+"""The compact model.npz artifact against the sklearn model it exports."""
+import os
+import shutil
+import sys
+
+import joblib
+import numpy as np
+import pytest
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.linear_model import LogisticRegression, SGDClassifier
+
+from compact_model import CompactLinearModel, export_model, load_model
+from training import SGD_LOG_LOSS
+from transform import fit_imputation, save_statistics, scale_rows
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STS_DIR = os.path.join(ROOT_DIR, "sts")
+FEATURES = [f"f{i}" for i in range(6)]
+
+
+def features(rows, seed):
+    return scale_rows(np.random.RandomState(seed).rand(rows, len(FEATURES)))
+
+
+def labels(X):
+    return (X @ np.linspace(-1.0, 1.0, X.shape[1]) > 0).astype(np.int64)
+
+
+# the labels are binary, the default multi_class of sklearn 0.23 fits the
+# "ovr" model of training.py, later versions no longer take the argument
+MODELS = {
+    "lbfgs": lambda: LogisticRegression(max_iter=200),
+    "saga": lambda: LogisticRegression(max_iter=200, solver="saga"),
+    "sgd": lambda: SGDClassifier(loss=SGD_LOG_LOSS, random_state=0),
+}
+
+
+@pytest.fixture(params=sorted(MODELS))
+def model(request):
+    X = features(2000, 0)
+    dtype = np.float32 if request.param == "saga" else np.float64
+    return MODELS[request.param]().fit(X.astype(dtype), labels(X))
+
+
+def test_predictions_are_identical(model, tmp_path):
+    path = str(tmp_path / "model.npz")
+    assert export_model(model, path, FEATURES)
+    compact = load_model(path)
+    assert isinstance(compact, CompactLinearModel)
+    assert compact.feature_names == FEATURES
+    np.testing.assert_array_equal(compact.classes_, model.classes_)
+    X = features(5000, 1)
+    # rows projected on the decision boundary, their scores are rounding
+    # errors of either sign
+    w = model.coef_[0].astype(np.float64)
+    X[:500] -= np.outer(
+        (X[:500] @ w + model.intercept_[0]) / (w @ w), w)
+    for dtype in (np.float32, np.float64):
+        rows = X.astype(dtype)
+        np.testing.assert_array_equal(
+            compact.decision_function(rows), model.decision_function(rows))
+        np.testing.assert_array_equal(
+            compact.predict(rows), model.predict(rows))
+        np.testing.assert_array_equal(
+            compact.predict(rows[0]), model.predict(rows[:1]))
+
+
+def test_rejects_other_features(model, tmp_path):
+    path = str(tmp_path / "model.npz")
+    export_model(model, path, FEATURES)
+    with pytest.raises(ValueError):
+        load_model(path).predict(np.zeros((1, len(FEATURES) + 1)))
+    with pytest.raises(ValueError):
+        load_model(path).predict(np.zeros((0, len(FEATURES))))
+
+
+def test_models_not_linear_are_not_exported(tmp_path):
+    X = features(200, 0)
+    forest = RandomForestClassifier(n_estimators=5).fit(X, labels(X))
+    path = str(tmp_path / "model.npz")
+    assert not export_model(forest, path, FEATURES)
+    assert not os.path.exists(path)
+
+
+@pytest.fixture
+def model_loader():
+    pytest.importorskip("sagemaker_containers")
+    sys.path.insert(0, ROOT_DIR)
+    try:
+        import model_loader
+        yield model_loader
+    finally:
+        sys.path.remove(ROOT_DIR)
+
+
+def model_dir(path, model, compact):
+    """A model folder as training.py writes it."""
+    path.mkdir()
+    joblib.dump(model, path / "model.joblib")
+    if compact:
+        export_model(model, str(path / "model.npz"), FEATURES)
+        shutil.copy(os.path.join(STS_DIR, "compact_model.py"), path)
+    save_statistics(
+        str(path / "transform.json"), fit_imputation([features(2000, 0)]))
+    shutil.copy(os.path.join(STS_DIR, "transform.py"), path)
+    return str(path)
+
+
+def test_model_loader_prefers_the_compact_model(model, tmp_path,
+                                                model_loader):
+    compact = model_loader.model_fn(model_dir(tmp_path / "c", model, True))
+    full = model_loader.model_fn(model_dir(tmp_path / "f", model, False))
+    assert isinstance(compact[0], CompactLinearModel)
+    assert type(full[0]) is type(model)
+    assert compact[1] is not None and full[1] is not None
+
+    # distances as the endpoint gets them, not scaled, some missing
+    X = np.random.RandomState(2).rand(1000, len(FEATURES)) * 10
+    X[::7, 2] = np.nan
+    X[::50] = np.nan
+    for dtype in (np.float32, np.float64):
+        rows = X.astype(dtype)
+        np.testing.assert_array_equal(
+            model_loader.predict_fn(rows, compact),
+            model_loader.predict_fn(rows, full))
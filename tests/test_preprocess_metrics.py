@@ -0,0 +1,100 @@
+"""The batch distances of preprocess against the per pair sklearn ones."""
+import string
+import warnings
+
+import numpy as np
+import pytest
+from scipy.spatial.distance import cdist
+from sklearn.metrics.pairwise import pairwise_distances_argmin_min
+
+from preprocess import (
+    _STATISTICS_, _VALID_METRICS_, compute_distances, plan_metrics)
+
+SENTENCES = [
+    ("the cat sat on the mat", "the cat sat on the mat"),
+    ("the the the cat", "a cat cat, the dog!"),
+    ("Amrozi accused his brother", "Referring to him as only the witness"),
+    ("one two three four five", "five four three two one one"),
+    ("word", "word word word"),
+    ("a b c", "d e f g"),
+]
+
+
+def pair_distances(s1, s2, metrics):
+    """The distances of a pair as the original preprocess computed them,
+    with pairwise_distances_argmin_min over the count vectors of the pair.
+
+    seuclidean and yule are computed with scipy: later sklearn versions no
+    longer accept seuclidean without its variance V and give 0 instead of
+    the NaN of sklearn 0.23 to the 0 / 0 of yule.
+    """
+    table = str.maketrans("", "", string.punctuation)
+    words1, words2 = s1.translate(table).split(), s2.translate(table).split()
+    vocabulary = sorted(set(words1) | set(words2))
+    v1 = np.array([[words1.count(w) for w in vocabulary]], dtype=np.int32)
+    v2 = np.array([[words2.count(w) for w in vocabulary]], dtype=np.int32)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return [metric_distance(v1, v2, metric) for metric in metrics]
+
+
+def metric_distance(v1, v2, metric):
+    if metric == "seuclidean":
+        # the variance of each word over the two count vectors of the pair
+        variance = np.var(np.vstack([v1, v2]), axis=0, ddof=1)
+        return cdist(v1, v2, "seuclidean", V=variance)[0, 0]
+    if metric == "yule":
+        tf = np.count_nonzero((v1 != 0) & (v2 == 0))
+        ft = np.count_nonzero((v1 == 0) & (v2 != 0))
+        # 0 / 0 is NaN, see preprocess._yule
+        if tf * ft == 0:
+            return np.nan
+        return cdist(v1 != 0, v2 != 0, "yule")[0, 0]
+    return pairwise_distances_argmin_min(
+        v1, v2, axis=1, metric=metric)[1][0]
+
+
+@pytest.mark.parametrize("metric", _VALID_METRICS_)
+def test_metric_matches_sklearn(metric):
+    expected = np.array(
+        [pair_distances(s1, s2, [metric]) for s1, s2 in SENTENCES])
+    np.testing.assert_allclose(
+        compute_distances(SENTENCES, [metric]), expected,
+        rtol=1e-7, atol=1e-12, equal_nan=True)
+
+
+def test_all_metrics_at_once_match_sklearn():
+    expected = np.array(
+        [pair_distances(s1, s2, _VALID_METRICS_) for s1, s2 in SENTENCES])
+    np.testing.assert_allclose(
+        compute_distances(SENTENCES, _VALID_METRICS_), expected,
+        rtol=1e-7, atol=1e-12, equal_nan=True)
+
+
+def test_empty_pair_is_nan():
+    distances = compute_distances(
+        SENTENCES + [("", "!!")], _VALID_METRICS_)
+    assert np.isnan(distances[-1]).all()
+    assert not np.isnan(distances[0]).all()
+
+
+def test_workers_give_the_same_distances():
+    sentences = SENTENCES * 5
+    np.testing.assert_array_equal(
+        compute_distances(sentences, _VALID_METRICS_, workers=2),
+        compute_distances(sentences, _VALID_METRICS_, workers=1))
+
+
+def test_plan_shares_the_statistics():
+    formulas, statistics = plan_metrics(["l2", "euclidean", "sqeuclidean"])
+    assert formulas == ["euclidean", "sqeuclidean"]
+    assert len(statistics) == len(set(statistics))
+    assert "n" in statistics
+    for i, name in enumerate(statistics):
+        assert set(_STATISTICS_[name][0]) <= set(statistics[:i])
+
+
+def test_unknown_metric():
+    with pytest.raises(ValueError):
+        plan_metrics(["nope"])
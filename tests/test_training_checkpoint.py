@@ -0,0 +1,122 @@
+"""Resume of the incremental training from its checkpoints."""
+import numpy as np
+import pytest
+
+import splits
+import training
+
+CHUNK_SIZE = 100
+SETTINGS = {"epochs": 3, "chunk_size": CHUNK_SIZE, "alpha": 0.0001}
+
+
+class Interrupted(Exception):
+    pass
+
+
+@pytest.fixture
+def train_path(tmp_path):
+    random_state = np.random.RandomState(0)
+    X = random_state.rand(950, 4).astype(np.float32)
+    y = (X @ [1.0, -2.0, 0.5, 0.0] + 0.1 * random_state.randn(950) > 0)
+    path = tmp_path / "train"
+    path.mkdir()
+    np.save(path / "train.npy", np.column_stack([y, X]).astype(np.float32))
+    return str(path)
+
+
+def fit(train_path, checkpoint_dir=None, fingerprint=None, alpha=0.0001):
+    model, _ = training.fit_incremental(
+        train_path, SETTINGS["epochs"], CHUNK_SIZE, alpha,
+        checkpoint_dir=checkpoint_dir, checkpoint_every=3,
+        fingerprint=fingerprint)
+    return model
+
+
+def interrupt_after(monkeypatch, chunks):
+    """Makes the training raise once it has read the given chunks."""
+    read = []
+
+    def iter_split(*args, **kwargs):
+        for chunk in splits.iter_split(*args, **kwargs):
+            if len(read) == chunks:
+                raise Interrupted()
+            read.append(chunk)
+            yield chunk
+
+    monkeypatch.setattr(training, "iter_split", iter_split)
+
+
+def assert_same_model(model, expected):
+    np.testing.assert_array_equal(model.coef_, expected.coef_)
+    np.testing.assert_array_equal(model.intercept_, expected.intercept_)
+    assert model.t_ == expected.t_
+
+
+@pytest.mark.parametrize("chunks", [1, 3, 5, 10, 11, 25])
+def test_resume_fits_the_same_model(train_path, tmp_path, monkeypatch,
+                                    chunks):
+    expected = fit(train_path)
+    checkpoint_dir = str(tmp_path / "checkpoints")
+    fingerprint = training.training_fingerprint(train_path, SETTINGS)
+
+    with monkeypatch.context() as patch:
+        # the statistics pass reads 10 chunks before the training
+        interrupt_after(patch, 10 + chunks)
+        with pytest.raises(Interrupted):
+            fit(train_path, checkpoint_dir, fingerprint)
+
+    assert_same_model(
+        fit(train_path, checkpoint_dir, fingerprint), expected)
+
+
+def test_finished_checkpoint_gives_the_model(train_path, tmp_path):
+    checkpoint_dir = str(tmp_path / "checkpoints")
+    fingerprint = training.training_fingerprint(train_path, SETTINGS)
+    expected = fit(train_path, checkpoint_dir, fingerprint)
+    assert_same_model(fit(train_path, checkpoint_dir, fingerprint), expected)
+
+
+def test_checkpoint_of_another_run_is_ignored(train_path, tmp_path,
+                                              monkeypatch):
+    checkpoint_dir = str(tmp_path / "checkpoints")
+    other = dict(SETTINGS, alpha=0.01)
+    with monkeypatch.context() as patch:
+        interrupt_after(patch, 15)
+        with pytest.raises(Interrupted):
+            fit(train_path, checkpoint_dir,
+                training.training_fingerprint(train_path, other), alpha=0.01)
+
+    fingerprint = training.training_fingerprint(train_path, SETTINGS)
+    assert fingerprint != training.training_fingerprint(train_path, other)
+    assert training.load_checkpoint(checkpoint_dir, fingerprint) is None
+    assert_same_model(
+        fit(train_path, checkpoint_dir, fingerprint), fit(train_path))
+
+
+def test_fingerprint_changes_with_the_data(train_path):
+    fingerprint = training.training_fingerprint(train_path, SETTINGS)
+    rows = np.load(f"{train_path}/train.npy")
+    rows[-1, 1] += 1
+    np.save(f"{train_path}/train.npy", rows)
+    assert training.training_fingerprint(train_path, SETTINGS) != fingerprint
+
+
+def test_fingerprint_changes_with_a_middle_row(tmp_path):
+    # larger than the head and tail of the file, see training_fingerprint
+    rows = np.random.RandomState(0).rand(200000, 5).astype(np.float32)
+    assert rows.nbytes > 2 * 2 ** 20
+    np.save(tmp_path / "train.npy", rows)
+    fingerprint = training.training_fingerprint(str(tmp_path), SETTINGS)
+    rows[len(rows) // 2, 1] += 1
+    np.save(tmp_path / "train.npy", rows)
+    assert training.training_fingerprint(str(tmp_path), SETTINGS) != (
+        fingerprint)
+
+
+def test_cleared_checkpoint_is_not_resumed(train_path, tmp_path):
+    checkpoint_dir = str(tmp_path / "checkpoints")
+    fingerprint = training.training_fingerprint(train_path, SETTINGS)
+    fit(train_path, checkpoint_dir, fingerprint)
+    assert training.load_checkpoint(checkpoint_dir, fingerprint) is not None
+    training.clear_checkpoint(checkpoint_dir)
+    assert training.load_checkpoint(checkpoint_dir, fingerprint) is None
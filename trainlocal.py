@@ -0,0 +1,94 @@
+"""Execute the ML pipeline locally
+
+Will run the steps of the pipeline defined in sts/pipeline.py on this
+machine, without SageMaker, see sts/local_pipeline.py. The model is not
+registered.
+
+This will use the following configs from enviroment variables:
+
+- INPUT_DATA: the dataset, a local file or a S3 uri, defaults to
+  s3://sts-datwit-dataset/stsmsrpc.txt
+- LOCAL_WORK_DIR: the folder of the steps outputs, defaults to local_pipeline
+"""
+from sts.local_pipeline import run_local_pipeline
+from dotenv import load_dotenv
+import argparse
+import logging
+import json
+import os
+
+_l = logging.getLogger()
+logFormatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+consoleHandler = logging.StreamHandler()
+consoleHandler.setFormatter(logFormatter)
+_l.addHandler(consoleHandler)
+_l.setLevel(logging.INFO)
+load_dotenv()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--input-data", type=str,
+        default=os.getenv(
+            'INPUT_DATA', 's3://sts-datwit-dataset/stsmsrpc.txt'),
+        help="the dataset, a local file or a S3 uri")
+    parser.add_argument(
+        "--work-dir", type=str,
+        default=os.getenv('LOCAL_WORK_DIR', 'local_pipeline'),
+        help="the folder of the steps outputs")
+    parser.add_argument(
+        "--instance-count", type=int, default=1,
+        help="the number of simulated preprocessing instances")
+    parser.add_argument(
+        "--workers", type=int, default=0,
+        help="processes computing the features on each instance")
+    parser.add_argument(
+        "--metrics", type=str, default="all",
+        help="comma separated distance metrics to compute, or all")
+    parser.add_argument(
+        "--split-format", type=str, default="npy", choices=["npy", "csv"],
+        help="format of the train, validation and test splits")
+    parser.add_argument(
+        "--mse-threshold", type=float, default=6.0,
+        help="maximum mse of the model to pass the registration condition")
+    parser.add_argument(
+        "--latency-budget", type=float, default=100.0,
+        help="maximum p99 single row predict latency of the model, in "
+             "milliseconds, to pass the registration condition")
+    parser.add_argument(
+        "--training-mode", type=str, default="batch",
+        choices=["batch", "incremental", "search", "tournament"],
+        help="the training mode, see sts/training.py --mode")
+    parser.add_argument(
+        "--previous-model", type=str, default=None,
+        help="model.tar.gz the incremental training starts from")
+    args = parser.parse_args()
+
+    try:
+        outputs = run_local_pipeline(
+            args.input_data,
+            args.work_dir,
+            processing_instance_count=args.instance_count,
+            processing_workers=args.workers,
+            feature_metrics=args.metrics,
+            split_format=args.split_format,
+            mse_threshold=args.mse_threshold,
+            latency_budget=args.latency_budget,
+            training_mode=args.training_mode,
+            previous_model=args.previous_model)
+
+        _l.info("Pipeline finished!")
+        for name, seconds in outputs['timings'].items():
+            _l.info(f"{name}: {seconds:.2f} s")
+
+        # whrite the selected outputs to a json file
+        with open('trainlocal_out.json', 'w') as f:
+            json.dump(outputs, f)
+        # ---
+    except Exception as e:
+        _l.exception(f"Exception: {e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -9,10 +9,17 @@ This will use the following configs from enviroment variables:
 - PIPELINE_NAME
 - MODEL_PACKAGE_GROUP_NAME
 - BASE_JOB_PREFIX
+- INCREMENTAL_TRAINING: "true" to train incrementally from the latest
+  approved model, defaults to false
+- USE_SPOT_TRAINING: "true" to train on managed spot instances, with
+  checkpoints, defaults to false
+- INPUT_DATA: S3 uri of the dataset, defaults to the InputDataUrl
+  parameter default of the pipeline
 """
 from typing import List
 from sts.pipeline import get_pipeline
 from sts.utils import get_sm_session
+from botocore.exceptions import ClientError
 from dotenv import load_dotenv
 import sagemaker
 import boto3
@@ -55,6 +62,53 @@ def get_outputs(step: dict) -> dict:
     return response
 
 
+def get_input_data_version(s3_uri, b3_session) -> str:
+    """Returns the version of a S3 object, its VersionId or its ETag
+
+    The pipeline steps are cached by their arguments, the version changes
+    with the content of the dataset while its uri does not.
+
+    s3_uri: the S3 uri of the object
+    b3_session: boto3 session
+    """
+    bucket, _, key = s3_uri[len('s3://'):].partition('/')
+    try:
+        head = b3_session.client('s3').head_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        _l.warning(f"Error reading the version of {s3_uri}: {e}")
+        return 'unknown'
+    version = head.get('VersionId')
+    if version and version != 'null':
+        return version
+    return head['ETag'].strip('"')
+
+
+def get_execution_outputs(execution_steps, step_name, sm_client) -> dict:
+    """Returns the S3 uri outputs of the processing job run by a step
+
+    A step taken from the cache has the outputs of the job of a previous
+    execution, not the ones of the current pipeline definition.
+
+    execution_steps: the steps of the pipeline execution, see list_steps
+    step_name: the name of the processing step
+    sm_client: sagemaker boto3 client
+    """
+    response = {}
+    try:
+        for step in execution_steps:
+            if step.get('StepName') != step_name:
+                continue
+            job_arn = step['Metadata']['ProcessingJob']['Arn']
+            job = sm_client.describe_processing_job(
+                ProcessingJobName=job_arn.split('/')[-1])
+            for o in job['ProcessingOutputConfig']['Outputs']:
+                response[o['OutputName']] = o['S3Output']['S3Uri']
+    except Exception as e:
+        _l.debug(f"Error geting the outputs of the {step_name} job")
+
+    return response
+
+
 def main():
     # define some configurations from env
 
@@ -77,6 +131,11 @@ def main():
     MODEL_PACKAGE_GROUP_NAME = os.getenv(
         'MODEL_PACKAGE_GROUP_NAME', 'sts-sklearn-grp')
     BASE_JOB_PREFIX = os.getenv('BASE_JOB_PREFIX', 'sts')
+    INCREMENTAL_TRAINING = os.getenv(
+        'INCREMENTAL_TRAINING', 'false').lower() in ('true', '1', 'yes')
+    USE_SPOT_TRAINING = os.getenv(
+        'USE_SPOT_TRAINING', 'false').lower() in ('true', '1', 'yes')
+    INPUT_DATA = os.getenv('INPUT_DATA', None)
 
     outputs = {
         'pipeline': None,
@@ -92,7 +151,9 @@ def main():
             role=ROLE_ARN,
             pipeline_name=PIPELINE_NAME,
             model_package_group_name=MODEL_PACKAGE_GROUP_NAME,
-            base_job_prefix=BASE_JOB_PREFIX)
+            base_job_prefix=BASE_JOB_PREFIX,
+            incremental_training=INCREMENTAL_TRAINING,
+            use_spot_training=USE_SPOT_TRAINING)
 
         # output debug information
         parsed = json.loads(pipe.definition())
@@ -105,27 +166,40 @@ def main():
         _l.debug(
             f"C/U SageMaker Pipeline response received: {upsert_response}.")
 
+        # a dataset changed under the same uri misses the steps cache
+        input_data = INPUT_DATA or next(
+            p.default_value for p in pipe.parameters
+            if p.name == 'InputDataUrl')
+        input_data_version = get_input_data_version(input_data, b3_session)
+        _l.info(f"Input data {input_data}, version {input_data_version}.")
+
         _l.info("Starting the SageMaker pipeline.")
-        execution = pipe.start()
+        execution = pipe.start(parameters={
+            'InputDataUrl': input_data,
+            'InputDataVersion': input_data_version,
+        })
         _l.info("Waiting for the pipeline to finish.")
         execution.wait()
 
         _l.info("Pipeline finished!")
-        _l.debug(f"{pprint.pformat(execution.list_steps())}.")
+        execution_steps = execution.list_steps()
+        _l.debug(f"{pprint.pformat(execution_steps)}.")
 
         # Take the s3 uri of the baseline datatase baseline.csv
-        mse_step = extract_step_from_list(
-            parsed.get('Steps'), 'CheckMSESTSEvaluation')
+        # written by the evaluation step, see its validate output
         mon_step = extract_step_from_list(
-            mse_step.get('Arguments').get('IfSteps'),
-            'SetupMonitoringData'
-        )
+            parsed.get('Steps'), 'EvaluateSTSModel')
 
-        outputs['baseline'] = get_outputs(mon_step)
-        # take de s3 uri of train, validate, and test datasets
+        outputs['baseline'] = get_execution_outputs(
+            execution_steps, 'EvaluateSTSModel', sm_client
+        ) or get_outputs(mon_step)
+        # take de s3 uri of train, validate, and test datasets, written by
+        # the merge of the preprocessing shards
         train_step_def = extract_step_from_list(
-            parsed.get('Steps'), 'PreprocessSTSData')
-        outputs['train'] = get_outputs(train_step_def)
+            parsed.get('Steps'), 'MergeSTSData')
+        outputs['train'] = get_execution_outputs(
+            execution_steps, 'MergeSTSData', sm_client
+        ) or get_outputs(train_step_def)
         # --
 
         # whrite the pipeline def and the selected outputs to a json